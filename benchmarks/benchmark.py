@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import contextlib
+import numpy as np
+import pandas as pd
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from calibrate import calibrator
+from lake_calibrator.functions import read_observation_data, datetime_from_days
+from lake_calibrator.simstrat import (copy_simstrat_inputs, edit_par_file, set_simstrat_outputs, simstrat_rms,
+                                      compile_observation_index)
+from lake_calibrator.pest_calibrate import write_pest_ins_file, write_pest_pst_file
+
+FAKE_SIMSTRAT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_simstrat.py")
+REFERENCE_YEAR = 1981
+MAX_DEPTH = 250.0
+
+
+def create_lake(folder, years, depths, profiles_per_year=52, forcing_mb=1, seed=1):
+    simulation_folder = os.path.join(folder, "simulation")
+    os.makedirs(simulation_folder)
+    config = {
+        "Input": {"Morphology": "Morphology.dat", "Forcing": "Forcing.dat"},
+        "Output": {"Path": "Results", "Depths": 1, "Times": 1, "All": True},
+        "ModelParameters": {"a_seiche": 0.01, "f_wind": 1.0, "p_lw": 1.0, "snow_temp": 2.0},
+        "Simulation": {"Start d": 0, "End d": 365.25 * (years + 1), "Reference year": REFERENCE_YEAR,
+                       "DisplaySimulation": 1, "Continue from last snapshot": False, "Show progress bar": True,
+                       "Save text restart": False, "Use text restart": False}
+    }
+    with open(os.path.join(simulation_folder, "Settings.par"), "w") as f:
+        json.dump(config, f, indent=4)
+    with open(os.path.join(simulation_folder, "Morphology.dat"), "w") as f:
+        f.write("Depth [m] Area [m2]\n0 1000000\n{} 0\n".format(-MAX_DEPTH))
+    with open(os.path.join(simulation_folder, "Forcing.dat"), "wb") as f:
+        f.write(os.urandom(int(forcing_mb * 1024 ** 2)))
+
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("{}-01-01T10:00".format(REFERENCE_YEAR + 1), tz="UTC")
+    times = start + pd.to_timedelta(np.arange(int(years * profiles_per_year)) * 365.25 / profiles_per_year, unit="D")
+    times = times.round("min")
+    profile = np.round(np.geomspace(0.5, MAX_DEPTH - 1, depths), 2)
+    df = pd.DataFrame({
+        "time": np.repeat(times, depths).strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+        "depth": np.tile(profile, len(times)),
+        "latitude": 46.5,
+        "longitude": 6.6,
+        "value": rng.normal(12, 4, len(times) * depths).round(3),
+        "weight": 1
+    })
+    observation_file = os.path.join(folder, "temperature.csv")
+    df.to_csv(observation_file, index=False)
+    return {
+        "simulation_folder": simulation_folder,
+        "calibration_folder": os.path.join(folder, "calibration"),
+        "observations": [{
+            "file": observation_file,
+            "parameter": "temperature",
+            "unit": "degC",
+            "start": "1900-01-01T00:00:00+00:00",
+            "end": "2100-01-01T00:00:00+00:00"
+        }],
+        "simulation": "simstrat",
+        "execute": "{} {} {{calibration_folder}}/Calibration.par".format(sys.executable, FAKE_SIMSTRAT),
+        "parameters": [
+            {"name": "f_wind", "initial": 1.2, "min": 0.1, "max": 1.75},
+            {"name": "p_lw", "initial": 0.95, "min": 0.8, "max": 1.2}
+        ],
+        "calibration_framework": "scipy",
+        "calibration_options": {
+            "objective_function": "rms",
+            "objective_variables": ["temperature"],
+            "objective_weights": [1]
+        }
+    }
+
+
+def timed(function, repeat=1):
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        out = function()
+        durations.append(time.perf_counter() - start)
+    return min(durations), out
+
+
+def benchmark_setup(args, folder, repeat):
+    base_folder = os.path.join(folder, "base")
+    copy_simstrat_inputs(args["simulation_folder"], base_folder)
+    config = edit_par_file(base_folder, initial=True)
+    start_date = datetime(REFERENCE_YEAR + 1, 1, 1, tzinfo=timezone.utc)
+    end_date = datetime_from_days(config["Simulation"]["End d"], config["Simulation"]["Reference year"])
+    calib = args["calibration_options"]
+
+    def setup():
+        times, depths, observations = read_observation_data(calib, json.loads(json.dumps(args["observations"])),
+                                                            start_date, end_date, MAX_DEPTH)
+        index = compile_observation_index(calib["objective_variables"], calib["objective_weights"], observations)
+        return times, depths, observations, index
+
+    setup_time, (times, depths, observations, index) = timed(setup, repeat)
+    set_simstrat_outputs(base_folder, times, depths, REFERENCE_YEAR)
+    return setup_time, base_folder, times, depths, observations, index
+
+
+def benchmark_scale(years, depths, evaluations, workers, repeat, forcing_mb, sleep, rows_per_day):
+    folder = tempfile.mkdtemp(prefix="lake_calibrator_benchmark_")
+    try:
+        args = create_lake(folder, years, depths, forcing_mb=forcing_mb)
+        result = {"years": years, "depths": depths}
+        setup_time, base_folder, times, depths_out, observations, index = benchmark_setup(args, folder, repeat)
+        result["observations"] = int(sum(len(o["values"]) for o in index))
+        result["observation_setup_s"] = setup_time
+
+        pest_folder = os.path.join(folder, "pest")
+        os.makedirs(pest_folder)
+        calib = args["calibration_options"]
+        try:
+            ins_time, combined = timed(lambda: write_pest_ins_file(pest_folder, calib, "simstrat", observations, times,
+                                                                   depths_out), repeat)
+            pst_time, _ = timed(lambda: write_pest_pst_file(pest_folder, args["simulation_folder"], args["parameters"],
+                                                            "simstrat", calib, combined, "./run.sh"), repeat)
+        except ValueError as e:
+            print("PEST files not supported at this scale: {}".format(e), file=sys.stderr)
+            ins_time, pst_time = None, None
+        result["write_pest_ins_file_s"] = ins_time
+        result["write_pest_pst_file_s"] = pst_time
+
+        os.environ["FAKE_SIMSTRAT_SLEEP"] = str(sleep)
+        os.environ["FAKE_SIMSTRAT_ROWS_PER_DAY"] = str(rows_per_day)
+        os.system(args["execute"].format(calibration_folder=base_folder))
+        objective_time, _ = timed(lambda: simstrat_rms(index, REFERENCE_YEAR, os.path.join(base_folder, "Results")),
+                                  repeat)
+        result["objective_s"] = objective_time
+        result["output_mb"] = os.path.getsize(os.path.join(base_folder, "Results", "T_out.dat")) / 1024 ** 2
+
+        popsize = max(1, int(np.ceil(evaluations / (2 * len(args["parameters"])))))
+        args["calibration_options"].update({
+            "method": "differential_evolution",
+            "workers": workers,
+            "maxiter": 1,
+            "popsize": popsize,
+            "seed": 1,
+            "cache": False
+        })
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            out = calibrator(args)
+        result["evaluations"] = out["timings"]["evaluations"]
+        result["evaluations_per_second"] = out["timings"]["evaluations_per_hour"] / 3600
+        result["harness_overhead_s"] = float(sum(
+            s["median"] for k, s in out["timings"]["stages"].items() if k not in ["model", "total"]))
+        result["stages"] = out["timings"]["stages"]
+        return result
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Lake calibrator benchmarks')
+    parser.add_argument('--years', type=int, nargs="+", default=[1, 10, 40], help='Simulated years')
+    parser.add_argument('--depths', type=int, nargs="+", default=[10, 50, 200], help='Observed depths per profile')
+    parser.add_argument('--evaluations', type=int, default=8, help='Approximate model evaluations per scale')
+    parser.add_argument('--workers', type=int, default=1, help='Parallel evaluation workers')
+    parser.add_argument('--repeat', type=int, default=3, help='Repeats for the micro benchmarks (best is reported)')
+    parser.add_argument('--forcing-mb', type=float, default=1, help='Size of the synthetic forcing file')
+    parser.add_argument('--sleep', type=float, default=0, help='Emulated model run time in seconds')
+    parser.add_argument('--rows-per-day', type=float, default=0, help='Extra regular model output rows per day')
+    parser.add_argument('--output', help='Write the results to this json file')
+    args = parser.parse_args()
+
+    results = []
+    columns = ["years", "depths", "observations", "observation_setup_s", "write_pest_ins_file_s",
+               "write_pest_pst_file_s", "objective_s", "output_mb", "harness_overhead_s", "evaluations_per_second"]
+    print(" ".join("{:>22}".format(c) for c in columns))
+    for years in args.years:
+        for depths in args.depths:
+            result = benchmark_scale(years, depths, args.evaluations, args.workers, args.repeat, args.forcing_mb,
+                                     args.sleep, args.rows_per_day)
+            results.append(result)
+            print(" ".join("{:>22.4g}".format(result[c]) if isinstance(result[c], float) else "{:>22}".format(str(result[c]))
+                           for c in columns))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
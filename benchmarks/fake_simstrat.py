@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+
+def fake_simstrat(par_file, sleep=0.0, rows_per_day=0.0):
+    folder = os.path.dirname(os.path.abspath(par_file))
+    with open(par_file) as f:
+        config = json.load(f)
+    parameters = config["ModelParameters"]
+    times = np.loadtxt(os.path.join(folder, config["Output"]["Times"]), skiprows=1, ndmin=1)
+    depths = np.loadtxt(os.path.join(folder, config["Output"]["Depths"]), skiprows=1, ndmin=1)
+    if rows_per_day > 0:
+        regular = np.arange(config["Simulation"]["Start d"], config["Simulation"]["End d"], 1 / rows_per_day)
+        times = np.union1d(times, np.round(regular, 4))
+    times = times[(times >= config["Simulation"]["Start d"]) & (times <= config["Simulation"]["End d"])]
+
+    f_wind = parameters.get("f_wind", 1.0)
+    p_lw = parameters.get("p_lw", 1.0)
+    snow_temp = parameters.get("snow_temp", 2.0)
+    a_seiche = parameters.get("a_seiche", 0.01)
+    results = os.path.join(folder, config["Output"]["Path"])
+    snapshot = os.path.join(results, "simulation-snapshot.dat")
+    if config["Simulation"].get("Use text restart", False):
+        if not os.path.exists(snapshot):
+            raise ValueError("Text restart file {} not found".format(snapshot))
+        state = float(np.loadtxt(snapshot))
+    else:
+        state = 0.1 * snow_temp
+    season = np.sin(2 * np.pi * (times[:, None] - 100) / 365.25)
+    decay = np.exp(depths[None, :] / (15 * p_lw + 100 * a_seiche))
+    memory = state * np.exp(-(times[:, None] - config["Simulation"]["Start d"]) / 200)
+    temperature = 4 + 0.2 * snow_temp + (8 + 4 * f_wind) * (season + 1) * decay + memory
+
+    os.makedirs(results, exist_ok=True)
+    data = np.column_stack([times, temperature])
+    header = "Datetime," + ",".join("%.3f" % d for d in depths)
+    with open(os.path.join(results, "T_out.dat"), "w") as f:
+        f.write(header + "\n")
+        for chunk in np.array_split(data, 10 if sleep > 0 else 1):
+            if sleep > 0:
+                time.sleep(sleep / 10)
+            np.savetxt(f, chunk, delimiter=",", fmt="%.4f")
+            f.flush()
+    if config["Simulation"].get("Save text restart", False):
+        np.savetxt(snapshot, [0.1 * snow_temp])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Synthetic Simstrat stand-in for benchmarking')
+    parser.add_argument('par_file', help='Path to Calibration.par')
+    parser.add_argument('--sleep', type=float, default=float(os.environ.get("FAKE_SIMSTRAT_SLEEP", 0)),
+                        help='Seconds to sleep to emulate model run time')
+    parser.add_argument('--rows-per-day', type=float, default=float(os.environ.get("FAKE_SIMSTRAT_ROWS_PER_DAY", 0)),
+                        help='Additional regular output rows per day to increase the size of T_out.dat')
+    args = parser.parse_args()
+    try:
+        fake_simstrat(args.par_file, sleep=args.sleep, rows_per_day=args.rows_per_day)
+    except Exception as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
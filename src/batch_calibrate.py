@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import socket
+import argparse
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+from datetime import datetime
+from calibrate import calibrator
+from lake_calibrator.functions import Logger, verify_file
+from lake_calibrator.executor import pool_workers
+
+
+def read_arguments(arg_file):
+    try:
+        with open(arg_file) as f:
+            return json.load(f)
+    except:
+        raise ValueError("Failed to parse {}. Verify it is a valid json file.".format(arg_file))
+
+
+def requested_workers(args):
+    calib = args["calibration_options"]
+    if args["calibration_framework"] == "PEST":
+        return calib["agents"] if "agents" in calib else None
+    if args["calibration_framework"] == "scipy" and ("method" not in calib or calib["method"] == "Nelder-Mead"):
+        return pool_workers(args)
+    return calib["workers"] * pool_workers(args) if "workers" in calib else None
+
+
+def simulated_days(args):
+    folder = args["simulation_folder"]
+    par_files = [f for f in os.listdir(folder) if f.endswith(".par")]
+    if len(par_files) == 0:
+        return 1
+    with open(os.path.join(folder, par_files[0])) as f:
+        config = json.load(f)
+    return max(1, config["Simulation"]["End d"] - config["Simulation"]["Start d"])
+
+
+def free_port(port, used):
+    while True:
+        if port not in used:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                try:
+                    s.bind(("", port))
+                    return port
+                except OSError:
+                    pass
+        port += 1
+
+
+def plan_lakes(arg_files, workers, resume=False):
+    lakes = []
+    folders = {}
+    default_workers = max(1, workers // len(arg_files))
+    for arg_file in arg_files:
+        args = read_arguments(arg_file)
+        folder = os.path.abspath(args["calibration_folder"])
+        if folder in folders:
+            raise ValueError("{} and {} use the same calibration folder {}".format(folders[folder], arg_file, folder))
+        folders[folder] = arg_file
+        if resume:
+            args["resume"] = True
+        requested = requested_workers(args)
+        allocated = min(workers, requested if requested is not None else default_workers)
+        name = os.path.splitext(os.path.basename(arg_file))[0]
+        if name in [lake["name"] for lake in lakes]:
+            name = "{}_{}".format(name, len(lakes))
+        lakes.append({
+            "arg_file": arg_file,
+            "name": name,
+            "args": args,
+            "workers": allocated,
+            "cost": simulated_days(args) * len(args["parameters"]) / allocated,
+            "status": "queued"
+        })
+    return sorted(lakes, key=lambda lake: lake["cost"])
+
+
+def assign_resources(lake, port, used_ports):
+    calib = lake["args"]["calibration_options"]
+    if lake["args"]["calibration_framework"] == "PEST":
+        calib["agents"] = lake["workers"]
+        lake["port"] = calib["port"] = free_port(port, used_ports)
+    else:
+        calib["workers"] = lake["workers"]
+        if pool_workers(lake["args"]) > 1:
+            calib["executor"] = dict(calib["executor"], workers=min(calib["executor"]["workers"], lake["workers"]))
+        if "distributed" in calib and calib["distributed"]:
+            distributed = dict(calib["distributed"]) if isinstance(calib["distributed"], dict) else {}
+            start = distributed["port"] if "port" in distributed and distributed["port"] else port
+            lake["port"] = distributed["port"] = free_port(start, used_ports)
+            if "local_workers" in distributed:
+                distributed["local_workers"] = min(distributed["local_workers"], lake["workers"])
+            calib["distributed"] = distributed
+        if "screening" in calib and isinstance(calib["screening"], dict):
+            screening = calib["screening"]
+            screening["workers"] = min(screening["workers"], lake["workers"]) if "workers" in screening else lake["workers"]
+
+
+def run_lake(args, log_file):
+    with open(log_file, "a") as f:
+        os.dup2(f.fileno(), sys.stdout.fileno())
+        os.dup2(f.fileno(), sys.stderr.fileno())
+    try:
+        calibrator(args)
+    except:
+        traceback.print_exc()
+        sys.stdout.flush()
+        os._exit(1)
+
+
+def lake_summary(lake):
+    summary = {key: lake[key] for key in ["name", "arg_file", "status", "workers", "port", "start", "end", "seconds", "log"] if key in lake}
+    summary["calibration_folder"] = lake["args"]["calibration_folder"]
+    summary["calibration_framework"] = lake["args"]["calibration_framework"]
+    results_file = os.path.join(lake["args"]["calibration_folder"], "results.json")
+    if lake["status"] == "completed" and os.path.exists(results_file):
+        with open(results_file) as f:
+            results = json.load(f)
+        summary["results"] = results_file
+        summary["parameters"] = results["parameters"] if "parameters" in results else None
+        summary["error"] = results["error"] if "error" in results else None
+    return summary
+
+
+def write_index(path, workers, lakes):
+    with open(path + ".tmp", "w") as f:
+        json.dump({"workers": workers, "updated": datetime.now().isoformat(),
+                   "lakes": [lake_summary(lake) for lake in lakes]}, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+def batch_calibrator(arg_files, workers, index_file, log_folder, port=4005, resume=False):
+    log = Logger()
+    log.initialise("Lake Calibrator batch")
+    lakes = plan_lakes(arg_files, workers, resume=resume)
+    os.makedirs(log_folder, exist_ok=True)
+    log.info("Scheduling {} lakes on {} workers, shortest first".format(len(lakes), workers))
+    for lake in lakes:
+        log.info("{}: {} workers".format(lake["name"], lake["workers"]), indent=1)
+    write_index(index_file, workers, lakes)
+
+    running = {}
+    used_ports = set()
+    free = workers
+    try:
+        while len(running) > 0 or any(lake["status"] == "queued" for lake in lakes):
+            for lake in lakes:
+                if lake["status"] != "queued" or lake["workers"] > free:
+                    continue
+                assign_resources(lake, port, used_ports)
+                if "port" in lake:
+                    used_ports.add(lake["port"])
+                lake["log"] = os.path.join(log_folder, "{}.log".format(lake["name"]))
+                process = multiprocessing.Process(target=run_lake, args=(lake["args"], lake["log"]))
+                process.start()
+                running[lake["name"]] = (lake, process)
+                free -= lake["workers"]
+                lake["status"] = "running"
+                lake["start"] = datetime.now().isoformat()
+                log.info("Started {} with {} workers{}".format(
+                    lake["name"], lake["workers"], " on port {}".format(lake["port"]) if "port" in lake else ""), indent=1)
+                write_index(index_file, workers, lakes)
+
+            wait([process.sentinel for lake, process in running.values()])
+
+            for name, (lake, process) in list(running.items()):
+                if process.is_alive():
+                    continue
+                process.join()
+                del running[name]
+                free += lake["workers"]
+                used_ports.discard(lake["port"] if "port" in lake else None)
+                lake["status"] = "completed" if process.exitcode == 0 else "failed"
+                lake["end"] = datetime.now().isoformat()
+                lake["seconds"] = (datetime.fromisoformat(lake["end"]) - datetime.fromisoformat(lake["start"])).total_seconds()
+                log.info("{} {} after {:.0f} seconds".format(name, lake["status"], lake["seconds"]), indent=1)
+                write_index(index_file, workers, lakes)
+    finally:
+        for lake, process in running.values():
+            process.terminate()
+            process.join()
+            lake["status"] = "failed"
+        write_index(index_file, workers, lakes)
+    log.end("Batch complete, results index written to {}".format(index_file))
+    return lakes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Lake calibrator batch scheduler')
+    parser.add_argument('arg_files', type=verify_file, nargs='+', help='Paths to arguments files')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Total number of simulations run at once across all lakes')
+    parser.add_argument('--index', default='batch_results.json', help='Path of the combined results index')
+    parser.add_argument('--logs', default='batch_logs', help='Folder for the output of each lake')
+    parser.add_argument('--port', type=int, default=4005, help='First port tried for PEST and distributed calibrations')
+    parser.add_argument('--resume', action='store_true', help='Keep existing calibration folders and reuse cached evaluations')
+    args = parser.parse_args()
+    batch_calibrator(args.arg_files, args.workers, args.index, args.logs, port=args.port, resume=args.resume)
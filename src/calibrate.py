@@ -5,8 +5,11 @@ import shutil
 import argparse
 from lake_calibrator.functions import Logger
 from lake_calibrator.functions import verify_args, verify_file
+from lake_calibrator.executor import limit_pool_workers
 from lake_calibrator.scipy_calibrate import scipy_calibrate
 from lake_calibrator.pest_calibrate import pest_calibrate
+from lake_calibrator.lm_calibrate import lm_calibrate
+from lake_calibrator.sensitivity import sensitivity_analysis
 
 def calibrator(arguments):
     verify_args(arguments)
@@ -16,14 +19,22 @@ def calibrator(arguments):
         log = Logger()
     log.initialise("Lake Calibrator")
     log.inputs("Arguments", arguments)
-    if os.path.exists(arguments["calibration_folder"]):
-        log.info("Removing existing calibration folder")
-        shutil.rmtree(arguments["calibration_folder"])
-    os.makedirs(arguments["calibration_folder"])
+    if "resume" in arguments and arguments["resume"] and os.path.exists(arguments["calibration_folder"]):
+        log.info("Resuming from existing calibration folder")
+    else:
+        if os.path.exists(arguments["calibration_folder"]):
+            log.info("Removing existing calibration folder")
+            shutil.rmtree(arguments["calibration_folder"])
+        os.makedirs(arguments["calibration_folder"])
+    limit_pool_workers(arguments, log)
     if arguments["calibration_framework"] == "scipy":
         results = scipy_calibrate(arguments, log)
     elif arguments["calibration_framework"] == "PEST":
         results = pest_calibrate(arguments, log)
+    elif arguments["calibration_framework"] == "LM":
+        results = lm_calibrate(arguments, log)
+    elif arguments["calibration_framework"] == "sensitivity":
+        results = sensitivity_analysis(arguments, log)
     else:
         raise ValueError("Unrecognised calibration framework: {}".format(arguments["calibration_framework"]))
     log.inputs("Outputs", results)
@@ -34,11 +45,15 @@ def calibrator(arguments):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Lake calibrator')
     parser.add_argument('arg_file', type=verify_file, help='Path to arguments file')
+    parser.add_argument('--resume', action='store_true', help='Keep the existing calibration folder and reuse cached evaluations')
     args = parser.parse_args()
     arg_file = args.arg_file
+    resume = args.resume
     try:
         with open(arg_file) as f:
             args = json.load(f)
     except:
         raise ValueError("Failed to parse {}. Verify it is a valid json file.".format(arg_file))
+    if resume:
+        args["resume"] = True
     calibrator(args)
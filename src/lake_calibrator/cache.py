@@ -0,0 +1,99 @@
+import os
+import json
+import sqlite3
+import hashlib
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from contextlib import closing
+
+
+class EvaluationCache(object):
+    def __init__(self, path, inputs_hash):
+        self.path = path
+        self.inputs_hash = inputs_hash
+        with closing(self.connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS evaluations "
+                         "(key TEXT PRIMARY KEY, inputs_hash TEXT, parameters TEXT, result TEXT, created TEXT)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def key(self, parameter_values):
+        parameters = json.dumps([float(v) for v in parameter_values])
+        return hashlib.sha256("{}{}".format(self.inputs_hash, parameters).encode()).hexdigest(), parameters
+
+    def get(self, parameter_values):
+        key, parameters = self.key(parameter_values)
+        with closing(self.connect()) as conn:
+            row = conn.execute("SELECT result FROM evaluations WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, parameter_values, result):
+        key, parameters = self.key(parameter_values)
+        with closing(self.connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?, ?, ?)",
+                         (key, self.inputs_hash, parameters, json.dumps(result), datetime.now().isoformat()))
+
+    def count(self):
+        with closing(self.connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM evaluations WHERE inputs_hash = ?", (self.inputs_hash,)).fetchone()[0]
+
+
+def hash_inputs(folder, parameter_names, observation_index, execute):
+    sha = hashlib.sha256()
+    sha.update(execute.encode())
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            sha.update(os.path.relpath(path, folder).encode())
+            if file.endswith(".par"):
+                with open(path) as f:
+                    config = json.load(f)
+                for parameter in parameter_names:
+                    config["ModelParameters"].pop(parameter, None)
+                sha.update(json.dumps(config, sort_keys=True).encode())
+            else:
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        sha.update(chunk)
+    for observation in observation_index:
+        sha.update(observation["parameter"].encode())
+        sha.update(str(observation["objective_weight"]).encode())
+        for key in ["time_keys", "depths", "rows", "cols", "values", "weights"]:
+            sha.update(observation[key].tobytes())
+    return sha.hexdigest()
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def write_observation_frame(path, df):
+    arrays = {"time": df.index.tz_convert(None).values, "columns": np.array(df.columns, dtype=str)}
+    for i, column in enumerate(df.columns):
+        values = df[column].to_numpy()
+        arrays["column_{}".format(i)] = values.astype(str) if values.dtype.kind == "O" else values
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def read_observation_frame(path):
+    with np.load(path) as data:
+        columns = data["columns"].tolist()
+        index = pd.DatetimeIndex(data["time"], name="time").tz_localize("UTC")
+        return pd.DataFrame({column: data["column_{}".format(i)] for i, column in enumerate(columns)},
+                            index=index, columns=columns)
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import base64
+import shutil
+import socket
+import tarfile
+import argparse
+import ipaddress
+import tempfile
+import threading
+import traceback
+import subprocess
+import socketserver
+import numpy as np
+from .cache import hash_inputs
+from .functions import Logger
+
+coordinators = {}
+
+
+def encode_array(array):
+    array = np.ascontiguousarray(array)
+    return {"dtype": str(array.dtype), "shape": list(array.shape), "data": base64.b64encode(array.tobytes()).decode()}
+
+
+def decode_array(encoded):
+    return np.frombuffer(base64.b64decode(encoded["data"]), dtype=encoded["dtype"]).reshape(encoded["shape"]).copy()
+
+
+def encode_observation_index(observation_index):
+    return [{key: encode_array(value) if isinstance(value, np.ndarray) else value for key, value in observation.items()}
+            for observation in observation_index]
+
+
+def decode_observation_index(encoded):
+    return [{key: decode_array(value) if isinstance(value, dict) and "dtype" in value else value
+             for key, value in observation.items()} for observation in encoded]
+
+
+def send_message(stream, message, data=None):
+    stream.write(json.dumps(message).encode() + b"\n")
+    if data is not None:
+        shutil.copyfileobj(data, stream)
+    stream.flush()
+
+
+def receive_message(stream):
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    return json.loads(line)
+
+
+def distributed_options(calibration_options):
+    options = calibration_options["distributed"]
+    return dict(options) if isinstance(options, dict) else {}
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def coordinator_address(options):
+    host = options["host"] if "host" in options else "127.0.0.1"
+    return "127.0.0.1" if host in ["", "0.0.0.0"] else host, options["port"] if "port" in options else 5005
+
+
+class Coordinator(object):
+    def __init__(self, calibration_folder, execute, calibration_options, parameter_names, host="127.0.0.1", port=5005,
+                 token=None, timeout=None, warning_interval=600, log=None):
+        if token is None and not is_loopback(host):
+            raise ValueError('A "token" is required in the distributed options to accept workers on {}'.format(host))
+        self.calibration_folder = os.path.abspath(calibration_folder)
+        self.execute = execute
+        self.calibration_options = {key: value for key, value in calibration_options.items()
+                                    if key not in ["distributed", "executor"]}
+        self.parameter_names = parameter_names
+        self.token = token
+        self.timeout = timeout
+        self.warning_interval = warning_interval
+        self.log = Logger() if log is None else log
+        self.jobs = queue.Queue()
+        self.bases = {}
+        self.processes = []
+        self.closed = threading.Event()
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                coordinator.handle(self.rfile, self.wfile)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        socketserver.ThreadingTCPServer.daemon_threads = True
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def add_base(self, name, observation_index):
+        folder = os.path.join(self.calibration_folder, name)
+        key = hash_inputs(folder, self.parameter_names, observation_index, self.execute)
+        archive = os.path.join(self.calibration_folder, "{}.tar.gz".format(name))
+        with tarfile.open(archive + ".tmp", "w:gz") as tar:
+            tar.add(folder, arcname="base")
+        os.replace(archive + ".tmp", archive)
+        self.bases[key] = {
+            "archive": archive,
+            "setup": {
+                "execute": self.execute,
+                "parameter_names": self.parameter_names,
+                "calibration_options": self.calibration_options,
+                "observation_index": encode_observation_index(observation_index)
+            }
+        }
+        self.bases[name] = key
+        return key
+
+    def handle(self, rfile, wfile):
+        try:
+            message = receive_message(rfile)
+            if self.token is not None and ("token" not in message or message["token"] != self.token):
+                send_message(wfile, {"type": "error", "message": "Invalid token"})
+            elif message["type"] == "submit":
+                self.serve_submit(message, wfile)
+            elif message["type"] == "worker":
+                self.serve_worker(rfile, wfile, message["name"] if "name" in message else None)
+        except (OSError, ConnectionError, ValueError):
+            pass
+
+    def serve_submit(self, message, wfile):
+        if message["base"] not in self.bases:
+            send_message(wfile, {"type": "result", "worker": None,
+                                 "failure": "Base {} is not served by the coordinator".format(message["base"])})
+            return
+        job = {
+            "type": "job",
+            "key": self.bases[message["base"]],
+            "parameters": message["parameters"],
+            "threshold": message["threshold"],
+            "worker": None,
+            "done": threading.Event()
+        }
+        self.jobs.put(job)
+        start = warned = time.time()
+        while not job["done"].wait(timeout=1):
+            waited = time.time() - start
+            if self.timeout is not None and waited >= self.timeout:
+                job["result"] = {"type": "result", "worker": job["worker"],
+                                 "failure": "No result after {:.0f} seconds".format(waited)}
+                job["done"].set()
+                break
+            if time.time() - warned < self.warning_interval:
+                continue
+            warned = time.time()
+            self.log.warning("Evaluation has waited {:.0f} seconds, {}".format(
+                waited, "no worker has taken it" if job["worker"] is None else "running on {}".format(job["worker"])), indent=1)
+        send_message(wfile, job["result"])
+
+    def serve_worker(self, rfile, wfile, name):
+        while not self.closed.is_set():
+            try:
+                job = self.jobs.get(timeout=1)
+            except queue.Empty:
+                continue
+            if job["done"].is_set():
+                continue
+            job["worker"] = name
+            try:
+                send_message(wfile, {key: value for key, value in job.items() if key not in ["done", "worker"]})
+                while True:
+                    message = receive_message(rfile)
+                    if message["type"] == "base":
+                        base = self.bases[message["key"]]
+                        with open(base["archive"], "rb") as f:
+                            send_message(wfile, {"type": "base", "setup": base["setup"],
+                                                 "size": os.path.getsize(base["archive"])}, data=f)
+                    elif message["type"] == "result":
+                        break
+            except (OSError, ConnectionError, ValueError):
+                job["worker"] = None
+                self.jobs.put(job)
+                return
+            if job["done"].is_set():
+                continue
+            job["result"] = message
+            job["done"].set()
+        try:
+            send_message(wfile, {"type": "stop"})
+        except OSError:
+            pass
+
+    def start_local_workers(self, workers, cache_folder):
+        for worker in range(workers):
+            command = [sys.executable, "-m", "lake_calibrator.distributed", "127.0.0.1:{}".format(self.port),
+                       "--cache", cache_folder, "--name", "local-{}".format(worker)]
+            if self.token is not None:
+                command += ["--token", self.token]
+            self.processes.append(subprocess.Popen(command, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                   stdout=subprocess.DEVNULL))
+
+    def close(self):
+        self.closed.set()
+        for process in self.processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_coordinator(args, log):
+    calib = args["calibration_options"]
+    if "distributed" not in calib or not calib["distributed"]:
+        return None
+    if "spin_up" in calib and isinstance(calib["spin_up"], dict) and "refresh" in calib["spin_up"]:
+        raise ValueError("Refreshing the spin up is not supported with distributed evaluation")
+    options = distributed_options(calib)
+    coordinator = Coordinator(args["calibration_folder"], args["execute"], calib,
+                              [parameter["name"] for parameter in args["parameters"]],
+                              host=options["host"] if "host" in options else "127.0.0.1",
+                              port=options["port"] if "port" in options else 5005,
+                              token=options["token"] if "token" in options else None,
+                              timeout=options["timeout"] if "timeout" in options else None,
+                              warning_interval=options["warning_interval"] if "warning_interval" in options else 600,
+                              log=log)
+    options["port"] = coordinator.port
+    calib["distributed"] = options
+    coordinators[os.path.abspath(args["calibration_folder"])] = coordinator
+    log.info("Coordinator listening on port {}".format(coordinator.port), indent=1)
+    if "local_workers" in options and options["local_workers"] > 0:
+        cache_folder = options["cache"] if "cache" in options else os.path.join(os.path.abspath(args["calibration_folder"]), "workers")
+        log.info("Starting {} local workers".format(options["local_workers"]), indent=1)
+        coordinator.start_local_workers(options["local_workers"], cache_folder)
+    return coordinator
+
+
+def register_base(args, base, observation_index):
+    folder = os.path.abspath(args["calibration_folder"])
+    if folder in coordinators:
+        coordinators[folder].add_base(base, observation_index)
+
+
+def close_coordinators():
+    for folder in list(coordinators.keys()):
+        coordinators.pop(folder).close()
+
+
+atexit.register(close_coordinators)
+
+
+def submit_job(calibration_options, base, parameter_values, threshold=None):
+    options = distributed_options(calibration_options)
+    with socket.create_connection(coordinator_address(options)) as sock:
+        rfile, wfile = sock.makefile("rb"), sock.makefile("wb")
+        send_message(wfile, {
+            "type": "submit",
+            "token": options["token"] if "token" in options else None,
+            "base": base,
+            "parameters": [float(value) for value in parameter_values],
+            "threshold": None if threshold is None else float(threshold)
+        })
+        result = receive_message(rfile)
+    if result["type"] == "error":
+        raise ValueError("Coordinator refused the evaluation: {}".format(result["message"]))
+    if "failure" in result:
+        raise RuntimeError("Distributed evaluation failed on worker {}\n{}".format(result["worker"], result["failure"]))
+    return result["error"], None if result["simulated"] is None else decode_array(result["simulated"])
+
+
+def extract_base(archive, folder):
+    with tarfile.open(archive) as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(folder, filter="data")
+            return
+        root = os.path.realpath(folder)
+        for member in tar.getmembers():
+            paths = [member.name] + ([member.linkname] if member.islnk() else [])
+            inside = all(os.path.commonpath([root, os.path.realpath(os.path.join(folder, path))]) == root for path in paths)
+            if not inside or not (member.isfile() or member.isdir() or member.islnk()):
+                raise ValueError("Refusing to extract {} from {}".format(member.name, archive))
+            member.mode = member.mode & 0o755
+        tar.extractall(folder)
+
+
+def fetch_base(rfile, wfile, key, cache_folder):
+    folder = os.path.join(cache_folder, key)
+    if not os.path.exists(os.path.join(folder, "setup.json")):
+        send_message(wfile, {"type": "base", "key": key})
+        message = receive_message(rfile)
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix="{}_".format(key), dir=cache_folder)
+        with open(os.path.join(tmp, "base.tar.gz"), "wb") as f:
+            remaining = message["size"]
+            while remaining > 0:
+                chunk = rfile.read(min(remaining, 1 << 20))
+                if not chunk:
+                    raise ConnectionError("Connection closed while receiving base {}".format(key))
+                f.write(chunk)
+                remaining -= len(chunk)
+        extract_base(os.path.join(tmp, "base.tar.gz"), tmp)
+        os.remove(os.path.join(tmp, "base.tar.gz"))
+        with open(os.path.join(tmp, "setup.json"), "w") as f:
+            json.dump(message["setup"], f)
+        try:
+            os.rename(tmp, folder)
+        except OSError:
+            shutil.rmtree(tmp)
+    with open(os.path.join(folder, "setup.json")) as f:
+        setup = json.load(f)
+    setup["folder"] = folder
+    setup["observation_index"] = decode_observation_index(setup["observation_index"])
+    return setup
+
+
+def run_job(setup, job, name, log, execute=None):
+    from .scipy_calibrate import simstrat304_run
+    args = {
+        "calibration_folder": setup["folder"],
+        "execute": setup["execute"] if execute is None else execute,
+        "parameters": [{"name": parameter} for parameter in setup["parameter_names"]],
+        "calibration_options": setup["calibration_options"]
+    }
+    try:
+        error, simulated = simstrat304_run(job["parameters"], args, log, setup["observation_index"], keep=False,
+                                           threshold=job["threshold"])
+    except Exception:
+        return {"type": "result", "worker": name, "failure": traceback.format_exc()}
+    return {"type": "result", "worker": name, "error": error,
+            "simulated": None if simulated is None else encode_array(simulated)}
+
+
+def distributed_worker(address, cache_folder, execute=None, token=None, name=None, retry=60):
+    log = Logger()
+    name = "{}-{}".format(socket.gethostname(), os.getpid()) if name is None else name
+    host, port = address.rsplit(":", 1)
+    start = time.time()
+    while True:
+        try:
+            sock = socket.create_connection((host, int(port)))
+            break
+        except OSError:
+            if time.time() - start > retry:
+                raise
+            time.sleep(1)
+    setups = {}
+    with sock:
+        rfile, wfile = sock.makefile("rb"), sock.makefile("wb")
+        send_message(wfile, {"type": "worker", "name": name, "token": token})
+        log.info("Worker {} connected to {}".format(name, address))
+        while True:
+            try:
+                job = receive_message(rfile)
+            except ConnectionError:
+                log.info("Coordinator closed the connection")
+                break
+            if job["type"] == "stop":
+                break
+            if job["type"] == "error":
+                raise ValueError("Coordinator refused worker {}: {}".format(name, job["message"]))
+            if job["key"] not in setups:
+                setups[job["key"]] = fetch_base(rfile, wfile, job["key"], os.path.abspath(cache_folder))
+            send_message(wfile, run_job(setups[job["key"]], job, name, log, execute=execute))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Lake calibrator distributed worker')
+    parser.add_argument('address', help='Coordinator host:port')
+    parser.add_argument('--cache', default='worker_cache', help='Folder for the local copies of the model inputs')
+    parser.add_argument('--execute', default=None, help='Execute command to use on this node instead of the one in the arguments file')
+    parser.add_argument('--token', default=None, help='Token set in the distributed calibration options')
+    parser.add_argument('--name', default=None, help='Worker name')
+    parser.add_argument('--retry', type=float, default=60, help='Seconds to keep trying to reach the coordinator')
+    args = parser.parse_args()
+    distributed_worker(args.address, args.cache, execute=args.execute, token=args.token, name=args.name, retry=args.retry)
@@ -0,0 +1,211 @@
+import os
+import json
+import queue
+import shlex
+import atexit
+import signal
+import subprocess
+from .worker import DONE
+
+executors = {}
+
+
+class EvaluationAborted(Exception):
+    pass
+
+
+def stop_process(process):
+    try:
+        if os.name == "nt":
+            process.terminate()
+        else:
+            os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        if os.name == "nt":
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.communicate()
+
+
+def wait_for_abort(process, command, debug=False, abort=None, interval=5):
+    while True:
+        try:
+            stdout, stderr = process.communicate(timeout=interval)
+            break
+        except subprocess.TimeoutExpired:
+            if abort():
+                stop_process(process)
+                raise EvaluationAborted(command)
+    if stdout and debug:
+        print(stdout.strip())
+    if stderr and debug:
+        print(stderr.strip())
+    if process.returncode != 0:
+        error_message = f"Command failed with return code {process.returncode}\n"
+        error_message += f"Command: {command}\n"
+        error_message += f"Standard Error: {stderr}\n"
+        raise RuntimeError(error_message)
+
+
+def wait_for_process(process, command, debug=False):
+    while True:
+        output = process.stdout.readline()
+        if output == '' and process.poll() is not None:
+            break
+        if output and debug:
+            print(output.strip())
+    stderr = process.communicate()[1]
+    if stderr and debug:
+        print(stderr.strip())
+    if process.returncode != 0:
+        error_message = f"Command failed with return code {process.returncode}\n"
+        error_message += f"Command: {command}\n"
+        error_message += f"Standard Error: {stderr}\n"
+        raise RuntimeError(error_message)
+
+
+class ShellExecutor(object):
+    def run(self, command, debug=False, cwd=None, abort=None, interval=5):
+        if abort is not None:
+            process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                       cwd=cwd, start_new_session=os.name != "nt")
+            return wait_for_abort(process, command, debug=debug, abort=abort, interval=interval)
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=cwd)
+        wait_for_process(process, command, debug=debug)
+
+    def close(self):
+        pass
+
+
+class LocalExecutor(object):
+    def run(self, command, debug=False, cwd=None, abort=None, interval=5):
+        if abort is not None:
+            process = subprocess.Popen(shlex.split(command, posix=os.name != "nt"), stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, text=True, cwd=cwd, start_new_session=os.name != "nt")
+            return wait_for_abort(process, command, debug=debug, abort=abort, interval=interval)
+        process = subprocess.Popen(shlex.split(command, posix=os.name != "nt"), stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, text=True, cwd=cwd)
+        wait_for_process(process, command, debug=debug)
+
+    def close(self):
+        pass
+
+
+class WorkerPoolExecutor(object):
+    def __init__(self, command, workers=1, calibration_folder=""):
+        self.command = command
+        self.calibration_folder = os.path.abspath(calibration_folder)
+        self.idle = queue.Queue()
+        self.processes = []
+        for worker in range(workers):
+            self.idle.put(self.start(worker))
+
+    def start(self, worker):
+        command = self.command.format(calibration_folder=self.calibration_folder, worker=worker)
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, text=True, bufsize=1)
+        self.processes.append(process)
+        return worker, process
+
+    def run(self, command, debug=False, cwd=None, abort=None, interval=5):
+        if cwd is None:
+            raise ValueError("Worker pool executor requires the run folder as cwd")
+        worker, process = self.idle.get()
+        try:
+            process.stdin.write(os.path.abspath(cwd) + "\n")
+            process.stdin.flush()
+            output = []
+            while True:
+                line = process.stdout.readline()
+                if line == '':
+                    raise RuntimeError("Worker {} exited unexpectedly\nOutput: {}".format(worker, "".join(output[-20:])))
+                if line.startswith(DONE):
+                    return_code = int(line.split()[1])
+                    break
+                output.append(line)
+                if debug:
+                    print(line.strip())
+        except (OSError, RuntimeError, ValueError):
+            process.kill()
+            self.idle.put(self.start(worker))
+            raise
+        self.idle.put((worker, process))
+        if return_code != 0:
+            error_message = f"Worker {worker} failed with return code {return_code}\n"
+            error_message += f"Run folder: {cwd}\n"
+            error_message += "Output: {}\n".format("".join(output[-20:]))
+            raise RuntimeError(error_message)
+
+    def close(self):
+        for process in self.processes:
+            if process.poll() is None:
+                try:
+                    process.stdin.close()
+                    process.wait(timeout=30)
+                except (OSError, subprocess.TimeoutExpired):
+                    process.kill()
+        self.processes = []
+
+
+def parallel_evaluations(args):
+    calib = args["calibration_options"]
+    if args["calibration_framework"] == "scipy":
+        return ("method" in calib and calib["method"] != "Nelder-Mead") or "screening" in calib
+    return args["calibration_framework"] in ["LM", "sensitivity"]
+
+
+def pool_workers(args):
+    calib = args["calibration_options"]
+    options = calib["executor"] if "executor" in calib else None
+    if not isinstance(options, dict) or options["type"] != "pool" or parallel_evaluations(args):
+        return 1
+    return options["workers"] if "workers" in options else 1
+
+
+def limit_pool_workers(args, log):
+    calib = args["calibration_options"]
+    options = calib["executor"] if "executor" in calib else None
+    if not isinstance(options, dict) or options["type"] != "pool":
+        return
+    if "early_abort" in calib and calib["early_abort"]:
+        log.warning("The pool executor cannot stop a running simulation, early_abort is ignored", indent=1)
+    if "workers" in options and options["workers"] > pool_workers(args):
+        log.warning("Each evaluation process starts its own pool and runs one simulation at a time, using 1 pool "
+                    "worker per process instead of {}".format(options["workers"]), indent=1)
+        calib["executor"] = dict(options, workers=pool_workers(args))
+
+
+def get_executor(calibration_options, calibration_folder=""):
+    if "executor" not in calibration_options:
+        options = {"type": "shell"}
+    elif isinstance(calibration_options["executor"], str):
+        options = {"type": calibration_options["executor"]}
+    else:
+        options = calibration_options["executor"]
+    key = (os.getpid(), json.dumps(options, sort_keys=True), os.path.abspath(calibration_folder))
+    if key not in executors:
+        if options["type"] == "shell":
+            executors[key] = ShellExecutor()
+        elif options["type"] == "local":
+            executors[key] = LocalExecutor()
+        elif options["type"] == "pool":
+            if "command" not in options:
+                raise ValueError("A worker command must be defined for the pool executor")
+            workers = options["workers"] if "workers" in options else 1
+            executors[key] = WorkerPoolExecutor(options["command"], workers=workers, calibration_folder=calibration_folder)
+        else:
+            raise ValueError("Unrecognised executor {}".format(options["type"]))
+    return executors[key]
+
+
+def close_executors():
+    for key in list(executors.keys()):
+        if key[0] == os.getpid():
+            executors.pop(key).close()
+
+
+atexit.register(close_executors)
@@ -1,40 +1,73 @@
 import os
+import time
 import numpy as np
 import traceback
-import subprocess
 import pandas as pd
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
+from .executor import ShellExecutor
+from .cache import hash_file, read_observation_frame, write_observation_frame
 
+OBSERVATION_CACHE_VERSION = 1
 
-def run_subprocess(command, debug=False, cwd=None):
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=cwd)
+
+def run_subprocess(command, debug=False, cwd=None, executor=None, abort=None, interval=5):
+    if executor is None:
+        executor = ShellExecutor()
+    if abort is None:
+        executor.run(command, debug=debug, cwd=cwd)
+    else:
+        executor.run(command, debug=debug, cwd=cwd, abort=abort, interval=interval)
+
+@contextmanager
+def folder_lock(path, timeout=600):
+    start = time.time()
     while True:
-        output = process.stdout.readline()
-        if output == '' and process.poll() is not None:
+        try:
+            os.mkdir(path)
             break
-        if output and debug:
-            print(output.strip())
-    stderr = process.communicate()[1]
-    if stderr and debug:
-        print(stderr.strip())
-    if process.returncode != 0:
-        error_message = f"Command failed with return code {process.returncode}\n"
-        error_message += f"Command: {command}\n"
-        error_message += f"Standard Error: {stderr}\n"
-        raise RuntimeError(error_message)
-
-def parse_observation_file(file, start, end, max_depth=False):
+        except FileExistsError:
+            if time.time() - start > timeout:
+                raise TimeoutError("Unable to acquire lock {}".format(path))
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.rmdir(path)
+
+def clean_observation_file(file):
     df = pd.read_csv(file)
     df['time'] = pd.to_datetime(df['time'], utc=True)
     df['time'] = df['time'].dt.round('min')
     df = df.drop_duplicates()
     df = df.set_index('time')
     df = df.sort_index()
-    df = df.loc[start:end]
     df["depth"] = df['depth'].abs()
+    return df.dropna()
+
+def cached_observation_file(file, cache_folder):
+    path = os.path.join(cache_folder, "{}.v{}.npz".format(hash_file(file), OBSERVATION_CACHE_VERSION))
+    if os.path.exists(path):
+        try:
+            return read_observation_frame(path)
+        except (OSError, ValueError, KeyError):
+            pass
+    df = clean_observation_file(file)
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        write_observation_frame(path, df)
+    except OSError as e:
+        print("WARNING: Unable to cache observations in {}: {}".format(cache_folder, e))
+    return df
+
+def parse_observation_file(file, start, end, max_depth=False, cache_folder=None):
+    if cache_folder is None:
+        df = clean_observation_file(file)
+    else:
+        df = cached_observation_file(file, cache_folder)
+    df = df.iloc[df.index.searchsorted(start, side="left"):df.index.searchsorted(end, side="right")]
     if max_depth:
-        df = df[df['depth'] <= max_depth]
-    df = df.dropna()
+        df = df[df['depth'].to_numpy() <= max_depth]
     if len(df) == 0:
         raise ValueError("No valid observations available")
     return df
@@ -48,11 +81,14 @@ def days_since_year(date, year):
     delta = date - reference_date
     return delta.total_seconds() / 86400.0
 
-def list_from_selection(selection):
-    if isinstance(selection, pd.Series):
-        return selection.values
-    else:
-        return [selection]
+def observation_cache_folder(calibration_options):
+    cache = calibration_options["observation_cache"] if "observation_cache" in calibration_options else True
+    if cache is True:
+        cache_home = os.environ["XDG_CACHE_HOME"] if "XDG_CACHE_HOME" in os.environ else os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(cache_home, "lake_calibrator", "observations")
+    elif cache:
+        return cache
+    return None
 
 def read_observation_data(calibration_options, observations, start_date, end_date, max_depth):
     times = []
@@ -64,7 +100,8 @@ def read_observation_data(calibration_options, observations, start_date, end_dat
         obs = observations[obs_ids[0]]
         start = max(start_date, datetime.fromisoformat(obs["start"]))
         end = min(end_date, datetime.fromisoformat(obs["end"]))
-        df = parse_observation_file(obs["file"], start, end, max_depth=max_depth)
+        df = parse_observation_file(obs["file"], start, end, max_depth=max_depth,
+                                    cache_folder=observation_cache_folder(calibration_options))
         times.extend(df.index.tolist())
         depths.extend([d for d in df["depth"].tolist() if not np.isnan(d)])
         observations[obs_ids[0]]["df"] = df
@@ -0,0 +1,124 @@
+import os
+import numpy as np
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from .simstrat import simstrat_residuals
+from .scipy_calibrate import clean_calibration_folder, prepare_simstrat, final_simulation, screen_parameters, simstrat304_run
+from .timing import summarise_timings
+from .distributed import start_coordinator, close_coordinators
+
+def lm_calibrate(args, log):
+    log.info("Calibrating {} with Levenberg-Marquardt".format(args["simulation"]))
+
+    calib = args["calibration_options"]
+    parameter_names = [parameter["name"] for parameter in args["parameters"]]
+    lower = np.array([parameter["min"] for parameter in args["parameters"]], dtype=float)
+    upper = np.array([parameter["max"] for parameter in args["parameters"]], dtype=float)
+    if np.any(upper <= lower):
+        raise ValueError("Levenberg-Marquardt requires max > min for every parameter")
+    x0 = [parameter["initial"] for parameter in args["parameters"]]
+
+    if "Calibration.par" not in args["execute"]:
+        raise ValueError('Execute command in argument file should contain "Calibration.par" NOT the name of your par file.')
+
+    clean_calibration_folder(args["calibration_folder"], log)
+    start_coordinator(args, log)
+
+    if args["simulation"] == "simstrat":
+        observation_index = prepare_simstrat(args, log)
+    else:
+        raise ValueError("Not implemented for {}".format(args["simulation"]))
+
+    if "screening" in calib:
+        x0 = screen_parameters(args, log, x0, list(zip(lower, upper)), parameter_names, observation_index, None)
+    u = np.clip((np.array(x0, dtype=float) - lower) / (upper - lower), 0, 1)
+
+    workers = calib["workers"] if "workers" in calib else os.cpu_count()
+    maxiter = calib["maxiter"] if "maxiter" in calib else 20
+    derinc = calib["derinc"] if "derinc" in calib else 0.01
+    lam = calib["lambda"] if "lambda" in calib else 1.0
+    lambda_factor = calib["lambda_factor"] if "lambda_factor" in calib else 10.0
+    lambdas = calib["lambdas"] if "lambdas" in calib else 3
+    phiredstp = calib["phiredstp"] if "phiredstp" in calib else 0.005
+    nphistp = calib["nphistp"] if "nphistp" in calib else 3
+    xtol = calib["xtol"] if "xtol" in calib else 0.001
+
+    start_time = datetime.now()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def evaluate(points):
+            values = [lower + np.clip(p, 0, 1) * (upper - lower) for p in points]
+            return list(pool.map(lm_evaluate, values, [args] * len(values), [log] * len(values),
+                                 [observation_index] * len(values)))
+
+        log.info("Evaluating Jacobians and lambda trials on {} workers".format(workers), indent=1)
+        error, r = evaluate([u])[0]
+        phi = float(r @ r)
+        phi_history = [phi]
+        stalled = 0
+        jacobian = None
+        message = "Reached maxiter"
+        for iteration in range(1, maxiter + 1):
+            log.info("Iteration {}: phi {}, rms {}".format(iteration, phi, error["overall"]), indent=1)
+            if jacobian is None:
+                steps = np.where(u + derinc <= 1, derinc, -derinc)
+                jacobian_runs = evaluate([u + np.eye(len(u))[i] * steps[i] for i in range(len(u))])
+                jacobian = np.column_stack([(ri - r) / steps[i] for i, (e, ri) in enumerate(jacobian_runs)])
+
+            jtj = jacobian.T @ jacobian
+            jtr = jacobian.T @ r
+            scale = np.diag(jtj).copy()
+            scale[scale <= 0] = 1
+            trial_lambdas = lam * lambda_factor ** (np.arange(lambdas) - (lambdas - 1) // 2)
+            trials = []
+            for trial_lambda in trial_lambdas:
+                try:
+                    step = np.linalg.solve(jtj + trial_lambda * np.diag(scale), -jtr)
+                except np.linalg.LinAlgError:
+                    step = np.linalg.lstsq(jtj + trial_lambda * np.diag(scale), -jtr, rcond=None)[0]
+                trials.append(np.clip(u + step, 0, 1))
+            trial_runs = evaluate(trials)
+            trial_phi = [float(ri @ ri) for e, ri in trial_runs]
+            best = int(np.argmin(trial_phi))
+
+            if trial_phi[best] >= phi:
+                lam = trial_lambdas[-1] * lambda_factor
+                stalled += 1
+                log.info("No lambda reduced phi, increasing lambda to {}".format(lam), indent=2)
+                if stalled >= nphistp:
+                    message = "Phi not reduced in {} iterations".format(nphistp)
+                    break
+                continue
+
+            change = np.max(np.abs(trials[best] - u))
+            reduction = (phi - trial_phi[best]) / phi if phi > 0 else 0
+            u, lam, jacobian = trials[best], trial_lambdas[best], None
+            error, r = trial_runs[best]
+            phi = trial_phi[best]
+            phi_history.append(phi)
+            log.info("Lambda {} reduced phi by {:.2%}".format(lam, reduction), indent=2)
+            stalled = stalled + 1 if reduction < phiredstp else 0
+            if stalled >= nphistp:
+                message = "Relative phi reduction below {} for {} iterations".format(phiredstp, nphistp)
+                break
+            if change < xtol:
+                message = "Parameter change below {}".format(xtol)
+                break
+    log.info("Levenberg-Marquardt finished: {}".format(message), indent=1)
+    close_coordinators()
+
+    parameter_values = lower + u * (upper - lower)
+    timings = summarise_timings(args["calibration_folder"], (datetime.now() - start_time).total_seconds(),
+                                since=start_time.isoformat())
+    error = final_simulation(args, log, parameter_names, parameter_values, observation_index)
+
+    return {
+        "parameters": dict(zip(parameter_names, parameter_values.tolist())),
+        "error": error,
+        "phi": phi_history,
+        "message": message,
+        "timings": timings
+    }
+
+def lm_evaluate(parameter_values, args, log, observation_index):
+    error, simulated = simstrat304_run(parameter_values, args, log, observation_index, threshold=np.inf)
+    return error, simstrat_residuals(observation_index, simulated)
@@ -0,0 +1,135 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import OptimizeResult
+
+RHO = 1
+CHI = 2
+PSI = 0.5
+SIGMA = 0.5
+NONZDELT = 0.05
+ZDELT = 0.00025
+
+
+class MaxFunctionCalls(Exception):
+    pass
+
+
+def call_function(fun, x, args, kwargs):
+    return fun(x, *args, **kwargs)
+
+
+def parallel_nelder_mead(fun, x0, args=(), bounds=None, maxfev=None, maxiter=None, fatol=1e-4, xatol=1e-4,
+                         workers=1, callback=None, early_abort=False):
+    x0 = np.asarray(x0, dtype=float)
+    N = len(x0)
+    if bounds is not None:
+        lower, upper = np.array(bounds, dtype=float).T
+        if (lower > upper).any():
+            raise ValueError("Nelder Mead - one of the lower bounds is greater than an upper bound.")
+        x0 = np.clip(x0, lower, upper)
+    if maxiter is None and maxfev is None:
+        maxiter, maxfev = N * 200, N * 200
+    elif maxiter is None:
+        maxiter = N * 200 if maxfev == np.inf else np.inf
+    elif maxfev is None:
+        maxfev = N * 200 if maxiter == np.inf else np.inf
+
+    def clip(x):
+        return x if bounds is None else np.clip(x, lower, upper)
+
+    sim = np.empty((N + 1, N), dtype=float)
+    sim[0] = x0
+    for k in range(N):
+        y = np.array(x0, copy=True)
+        y[k] = (1 + NONZDELT) * y[k] if y[k] != 0 else ZDELT
+        sim[k + 1] = y
+    if bounds is not None:
+        sim = np.clip(np.where(sim > upper, 2 * upper - sim, sim), lower, upper)
+
+    fcalls = [0]
+    runs = [0]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def evaluate(points, threshold=np.inf):
+            runs[0] += len(points)
+            kwargs = {"threshold": threshold} if early_abort else {}
+            return list(pool.map(call_function, [fun] * len(points), points, [args] * len(points),
+                                 [kwargs] * len(points)))
+
+        def use(value):
+            if fcalls[0] >= maxfev:
+                raise MaxFunctionCalls()
+            fcalls[0] += 1
+            return value
+
+        fsim = np.full((N + 1,), np.inf, dtype=float)
+        values = evaluate(list(sim))
+        try:
+            for k in range(N + 1):
+                fsim[k] = use(values[k])
+        except MaxFunctionCalls:
+            pass
+        ind = np.argsort(fsim)
+        sim = np.take(sim, ind, 0)
+        fsim = np.take(fsim, ind, 0)
+
+        iterations = 1
+        while fcalls[0] < maxfev and iterations < maxiter:
+            try:
+                if (np.max(np.ravel(np.abs(sim[1:] - sim[0]))) <= xatol and
+                        np.max(np.abs(fsim[0] - fsim[1:])) <= fatol):
+                    break
+
+                xbar = np.add.reduce(sim[:-1], 0) / N
+                xr = clip((1 + RHO) * xbar - RHO * sim[-1])
+                xe = clip((1 + RHO * CHI) * xbar - RHO * CHI * sim[-1])
+                xc = clip((1 + PSI * RHO) * xbar - PSI * RHO * sim[-1])
+                xcc = clip((1 - PSI) * xbar + PSI * sim[-1])
+                fxr, fxe, fxc, fxcc = evaluate([xr, xe, xc, xcc], threshold=fsim[-1])
+                fxr = use(fxr)
+                doshrink = False
+
+                if fxr < fsim[0]:
+                    fxe = use(fxe)
+                    if fxe < fxr:
+                        sim[-1], fsim[-1] = xe, fxe
+                    else:
+                        sim[-1], fsim[-1] = xr, fxr
+                elif fxr < fsim[-2]:
+                    sim[-1], fsim[-1] = xr, fxr
+                elif fxr < fsim[-1]:
+                    fxc = use(fxc)
+                    if fxc <= fxr:
+                        sim[-1], fsim[-1] = xc, fxc
+                    else:
+                        doshrink = True
+                else:
+                    fxcc = use(fxcc)
+                    if fxcc < fsim[-1]:
+                        sim[-1], fsim[-1] = xcc, fxcc
+                    else:
+                        doshrink = True
+
+                if doshrink:
+                    points = [clip(sim[0] + SIGMA * (sim[j] - sim[0])) for j in range(1, N + 1)]
+                    values = evaluate(points)
+                    for j in range(1, N + 1):
+                        sim[j] = points[j - 1]
+                        fsim[j] = use(values[j - 1])
+                iterations += 1
+            except MaxFunctionCalls:
+                pass
+            ind = np.argsort(fsim)
+            sim = np.take(sim, ind, 0)
+            fsim = np.take(fsim, ind, 0)
+            if callback is not None:
+                callback(sim[0])
+
+    if fcalls[0] >= maxfev:
+        status, message = 1, "Maximum number of function evaluations has been exceeded."
+    elif iterations >= maxiter:
+        status, message = 2, "Maximum number of iterations has been exceeded."
+    else:
+        status, message = 0, "Optimization terminated successfully."
+    return OptimizeResult(x=sim[0], fun=np.min(fsim), nit=iterations, nfev=fcalls[0], nruns=runs[0],
+                          status=status, success=status == 0, message=message, final_simplex=(sim, fsim))
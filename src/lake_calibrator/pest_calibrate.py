@@ -11,33 +11,57 @@ import pandas as pd
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
-from .functions import run_subprocess, read_observation_data, list_from_selection, datetime_from_days, days_since_year
-from .simstrat import set_simstrat_outputs, simstrat_max_depth
+from .functions import run_subprocess, read_observation_data, datetime_from_days, days_since_year
+from .pest_monitor import PestMonitor
+from .simstrat import set_simstrat_outputs, simstrat_max_depth, link_simstrat_inputs
 
 def pest_calibrate(args, log):
     log.info("Calibrating {} with PEST".format(args["simulation"]))
     if "docker_host_calibration_folder" not in args:
         args["docker_host_calibration_folder"] = os.path.abspath(args["calibration_folder"])
-    observations = pest_input_files(args, log)
+    docker = not ("docker" in args["calibration_options"] and not args["calibration_options"]["docker"])
+    if "resume" in args and args["resume"] and os.path.exists(os.path.join(args["calibration_folder"], "pest.pst")):
+        log.info("Resuming PEST with the existing input files")
+        with open(os.path.join(args["calibration_folder"], "observations.json")) as f:
+            observations = json.load(f)
+        switches, seed_file = pest_resume(args["calibration_folder"], args["calibration_options"], docker, log)
+    else:
+        if "seed_calibration" in args["calibration_options"]:
+            seed_pest_parameters(args["calibration_options"]["seed_calibration"], args["parameters"], log)
+        observations = pest_input_files(args, log)
+        switches, seed_file = [], None
+        if "seed_calibration" in args["calibration_options"]:
+            switches, seed_file = seed_pest_jacobian(args["calibration_folder"], args["calibration_options"]["seed_calibration"], docker, log)
     if "run" in args["calibration_options"] and not args["calibration_options"]["run"]:
         log.info("Not running PEST, existing after producing inputs.")
         return {}
     log.info("Running PEST")
     if "Calibration.par" not in args["execute"]:
         raise ValueError('Execute command in argument file should contain "Calibration.par" NOT the name of your par file.')
-    if "docker" in args["calibration_options"] and not args["calibration_options"]["docker"]:
-        pest_local(args["calibration_options"], args["calibration_folder"], args["execute"])
-    else:
-        cmd = ("docker run -v /var/run/docker.sock:/var/run/docker.sock -v {}:/pest/calibrate --rm "
-               "eawag/pest_hp:18.0.0 -f pest -a {} -p {}".format(args["docker_host_calibration_folder"],
-                                                                     args["calibration_options"]["agents"],
-                                                                     args["calibration_options"]["port"]))
-        log.info(cmd, indent=1)
-        debug = "debug" in args["calibration_options"] and args["calibration_options"]["debug"]
-        run_subprocess(cmd, debug=debug)
+    monitor = None
+    if "monitor" not in args["calibration_options"] or args["calibration_options"]["monitor"]:
+        interval = args["calibration_options"]["monitor_interval"] if "monitor_interval" in args["calibration_options"] else 30
+        monitor = PestMonitor(args["calibration_folder"], log, interval=interval)
+        monitor.start()
+    try:
+        if not docker:
+            pest_local(args["calibration_options"], args["calibration_folder"], args["execute"], switches=switches, seed_file=seed_file)
+        else:
+            cmd = ("docker run -v /var/run/docker.sock:/var/run/docker.sock -v {}:/pest/calibrate --rm "
+                   "eawag/pest_hp:18.0.0 -f pest -a {} -p {}".format(args["docker_host_calibration_folder"],
+                                                                         args["calibration_options"]["agents"],
+                                                                         args["calibration_options"]["port"]))
+            log.info(cmd, indent=1)
+            debug = "debug" in args["calibration_options"] and args["calibration_options"]["debug"]
+            run_subprocess(cmd, debug=debug)
+    finally:
+        if monitor is not None:
+            monitor.stop()
     log.info("PEST completed, reading output files.")
     result = pest_output_files(args["calibration_folder"], args["calibration_options"]["objective_variables"])
     result["observations"] = observations
+    if monitor is not None:
+        result["progress"] = monitor.summary()
     return result
 
 def pest_input_files(args, log):
@@ -75,6 +99,7 @@ def pest_input_files(args, log):
 
     log.info("Creating PEST .ins files", indent=1)
     combined_observations = write_pest_ins_file(args["calibration_folder"], args["calibration_options"], args["simulation"], observations, times, depths)
+    write_pest_observation_keys(args["calibration_folder"], combined_observations, times, depths)
 
     log.info("Creating PEST .pst file", indent=1)
     write_pest_pst_file(args["calibration_folder"], args["simulation_folder"], args["parameters"], args["simulation"], args["calibration_options"], combined_observations, run_file)
@@ -82,9 +107,151 @@ def pest_input_files(args, log):
     observations_summary = {}
     for obv in observations:
         observations_summary[obv["parameter"]] = {"times": len(set(obv["df"].index)), "depths": len(set(obv["df"]["depth"])), "total": len(obv["df"])}
+    with open(os.path.join(args["calibration_folder"], "observations.json"), "w") as f:
+        json.dump(observations_summary, f)
     return observations_summary
 
+def pest_resume(calibration_folder, calibration_options, docker, log):
+    pst_file = os.path.join(calibration_folder, "pest.pst")
+    with open(pst_file) as f:
+        f.readline()
+        f.readline()
+        restart = f.readline().split()[0] == "restart"
+    if restart and os.path.exists(os.path.join(calibration_folder, "pest.rst")) and not docker:
+        switch = calibration_options["restart_switch"] if "restart_switch" in calibration_options else "/r"
+        if switch not in ["/r", "/j"]:
+            raise ValueError('restart_switch must be "/r" or "/j", not {}'.format(switch))
+        log.info("Restarting PEST with {}".format(switch), indent=1)
+        return [switch], None
+    if restart and docker:
+        log.info("The PEST Docker image does not accept restart switches", indent=1)
+    par_file = os.path.join(calibration_folder, "pest.par")
+    if os.path.exists(par_file):
+        log.info("Restarting PEST from the parameters in pest.par", indent=1)
+        set_pest_initial_values(pst_file, read_pest_par_file(par_file))
+    else:
+        log.info("No PEST restart files or pest.par found, restarting from the initial parameters", indent=1)
+    return [], None
+
+def seed_pest_parameters(seed_calibration, parameters, log):
+    par_file = os.path.join(seed_calibration, "pest.par")
+    if not os.path.exists(par_file):
+        raise ValueError("Unable to seed calibration, {} does not exist".format(par_file))
+    values = read_pest_par_file(par_file)
+    for parameter in parameters:
+        if parameter["name"] in values:
+            parameter["initial"] = min(max(values[parameter["name"]], parameter["min"]), parameter["max"])
+            log.info("Seeding {} with {}".format(parameter["name"], parameter["initial"]), indent=1)
+
+def seed_pest_jacobian(calibration_folder, seed_calibration, docker, log):
+    jco_file = os.path.join(seed_calibration, "pest.jco")
+    if not os.path.exists(jco_file):
+        log.info("No Jacobian found in {}, PEST will compute it".format(seed_calibration), indent=1)
+        return [], None
+    if docker:
+        log.info("Reusing a Jacobian requires local PEST binaries, PEST will compute it", indent=1)
+        return [], None
+    names = read_pest_names(os.path.join(calibration_folder, "pest.pst"))
+    seed_keys = os.path.join(seed_calibration, "pest_observations.npz")
+    if not os.path.exists(seed_keys):
+        if read_pest_names(os.path.join(seed_calibration, "pest.pst")) != names:
+            log.info("Parameters or observations differ from {}, PEST will compute the Jacobian".format(seed_calibration), indent=1)
+            return [], None
+        log.info("Reusing the Jacobian from {} for the first iteration".format(seed_calibration), indent=1)
+        shutil.copy(jco_file, os.path.join(calibration_folder, "seed.jco"))
+        return ["/i"], "seed.jco"
+    jacobian, parameter_names, _ = read_pest_jco(jco_file)
+    columns = pd.Index(parameter_names).get_indexer([name.lower() for name in names["parameter data"]])
+    if np.any(columns < 0):
+        log.info("Parameters differ from {}, PEST will compute the Jacobian".format(seed_calibration), indent=1)
+        return [], None
+    rows = read_pest_observation_keys(seed_keys).get_indexer(
+        read_pest_observation_keys(os.path.join(calibration_folder, "pest_observations.npz")))
+    if np.any(rows < 0):
+        log.info("{} of {} observations are not in {}, PEST will compute the Jacobian".format(
+            np.sum(rows < 0), len(rows), seed_calibration), indent=1)
+        return [], None
+    log.info("Mapping the Jacobian from {} onto the {} observations for the first iteration".format(seed_calibration, len(rows)), indent=1)
+    write_pest_jco(os.path.join(calibration_folder, "seed.jco"), jacobian[np.ix_(rows, columns)],
+                   names["parameter data"], names["observation data"])
+    return ["/i"], "seed.jco"
+
+def write_pest_observation_keys(calibration_folder, combined_observations, times, depths):
+    times = pd.DatetimeIndex(times).asi8
+    depths_desc = np.array(sorted(depths, reverse=True), dtype=float)
+    np.savez(os.path.join(calibration_folder, "pest_observations.npz"),
+             group=np.concatenate([np.full(len(o["time_id"]), o["group"]) for o in combined_observations]),
+             time=np.concatenate([times[o["time_id"]] for o in combined_observations]),
+             depth=np.concatenate([depths_desc[o["depth_id"]] for o in combined_observations]))
+
+def read_pest_observation_keys(file):
+    with np.load(file) as data:
+        return pd.MultiIndex.from_arrays([data["group"], data["time"], data["depth"]])
+
+def read_pest_jco(jco_file):
+    with open(jco_file, "rb") as f:
+        parameters, observations = -np.fromfile(f, np.int32, 2)
+        count = int(np.fromfile(f, np.int32, 1)[0])
+        data = np.fromfile(f, [("index", np.int32), ("value", np.float64)], count)
+        parameter_names = [name.decode().strip().lower() for name in np.fromfile(f, "S12", parameters)]
+        observation_names = [name.decode().strip().lower() for name in np.fromfile(f, "S20", observations)]
+    jacobian = np.zeros((observations, parameters))
+    column, row = np.divmod(data["index"].astype(np.int64) - 1, observations)
+    jacobian[row, column] = data["value"]
+    return jacobian, parameter_names, observation_names
+
+def write_pest_jco(jco_file, jacobian, parameter_names, observation_names):
+    column, row = np.nonzero(jacobian.T)
+    data = np.empty(len(row), [("index", np.int32), ("value", np.float64)])
+    data["index"] = column * jacobian.shape[0] + row + 1
+    data["value"] = jacobian[row, column]
+    with open(jco_file, "wb") as f:
+        np.array([-jacobian.shape[1], -jacobian.shape[0], len(data)], dtype=np.int32).tofile(f)
+        data.tofile(f)
+        np.array([name.lower().ljust(12) for name in parameter_names], dtype="S12").tofile(f)
+        np.array([name.lower().ljust(20) for name in observation_names], dtype="S20").tofile(f)
+
+def read_pest_par_file(par_file):
+    values = {}
+    with open(par_file) as f:
+        f.readline()
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2:
+                values[parts[0]] = float(parts[1])
+    return values
+
+def read_pest_names(pst_file):
+    names = {"parameter data": [], "observation data": []}
+    section = None
+    with open(pst_file) as f:
+        for line in f:
+            if line.startswith("*"):
+                section = line[1:].strip()
+            elif section in names and line.strip() != "":
+                names[section].append(line.split()[0])
+    return names
+
+def set_pest_initial_values(pst_file, values):
+    with open(pst_file) as f:
+        lines = f.readlines()
+    section = None
+    for i, line in enumerate(lines):
+        if line.startswith("*"):
+            section = line[1:].strip()
+        elif section == "parameter data" and line.split()[0] in values:
+            parts = line.split()
+            value = min(max(values[parts[0]], float(parts[4])), float(parts[5]))
+            lines[i] = pest_parameter_line(parts[0], parts[2], value, float(parts[4]), float(parts[5]))
+    with open(pst_file, "w") as f:
+        f.writelines(lines)
+
+def pest_parameter_line(name, adjust, initial, minimum, maximum):
+    return '%6s\t%s\t%s\t%10.4e\t%10.4e\t%10.4e\t%4s\t1.0\t0.0\t1\n' % (name, "none", adjust, initial, minimum, maximum, "fit")
+
 def copy_model_inputs(output_folder, simulation_folder):
+    if os.path.exists(output_folder):
+        shutil.rmtree(output_folder)
     os.makedirs(output_folder)
     for item in os.listdir(simulation_folder):
         file = os.path.join(simulation_folder, item)
@@ -104,7 +271,15 @@ def write_pest_run_file(calibration_folder, docker_host_calibration_folder, exec
             file.write('#!/bin/bash\n')
             file.write('dir="$(dirname "$(realpath "$0")")"\n')
             file.write('folder=$(basename "$(dirname "$(realpath "$0")")")\n')
-            file.write('cp -r "/pest/calibrate/inputs"/* "$dir"/\n')
+            if link_inputs(calibration_options):
+                file.write('if [ ! -f "$dir/.inputs_linked" ]; then\n')
+                file.write('    cp -al "/pest/calibrate/inputs"/. "$dir"/ || cp -r "/pest/calibrate/inputs"/. "$dir"/\n')
+                file.write('    touch "$dir/.inputs_linked"\n')
+                file.write('fi\n')
+                file.write('rm -rf "$dir/Results"\n')
+                file.write('mkdir -p "$dir/Results"\n')
+            else:
+                file.write('cp -r "/pest/calibrate/inputs"/* "$dir"/\n')
             file.write(execute.format(calibration_folder=docker_host_calibration_folder + "/$folder") + "\n")
             file.write('echo "Run Complete"')
         os.chmod(os.path.join(calibration_folder, "run.sh"), 0o755)
@@ -120,8 +295,9 @@ def write_pest_pst_file(calibration_folder, simulation_folder, parameters, simul
     with open(os.path.join(calibration_folder, "pest.pst"), 'w') as file:
         file.write('pcf\n')
         file.write('* control data\n')
-        file.write('norestart estimation\n')
-        file.write('%d %d 1 0 %d\n' % (len(parameters), len(combined_observations), len(calibration_options["objective_variables"])))
+        restart = "restart" in calibration_options and calibration_options["restart"]
+        file.write('{} estimation\n'.format("restart" if restart else "norestart"))
+        file.write('%d %d 1 0 %d\n' % (len(parameters), sum(len(o["value"]) for o in combined_observations), len(calibration_options["objective_variables"])))
         file.write('1 %d single nopoint 1 0 0\n' % len(calibration_options["objective_variables"]))
         file.write('5.0 2.0 0.3 0.01 10 run_abandon_fac=1.5\n')
         file.write('5.0 5.0 0.001\n')
@@ -135,14 +311,12 @@ def write_pest_pst_file(calibration_folder, simulation_folder, parameters, simul
             adjust = "factor"
             if "adjust" in parameter:
                 adjust = parameter["adjust"]
-            file.write('%6s\t%s\t%s\t%10.4e\t%10.4e\t%10.4e\t%4s\t1.0\t0.0\t1\n' % (
-            parameter["name"], "none", adjust, parameter["initial"], parameter["min"], parameter["max"], "fit"))
+            file.write(pest_parameter_line(parameter["name"], adjust, parameter["initial"], parameter["min"], parameter["max"]))
         file.write('* observation groups\n')
         for objective_variable in calibration_options["objective_variables"]:
             file.write('{}\n'.format(objective_variable))
         file.write('* observation data\n')
-        for index, row in combined_observations.iterrows():
-            file.write('%-12s\t%12.4e\t%f\t%s\n' % (row["id"], row["value"], row["weight"], row["group"]))
+        write_pest_observation_data(file, combined_observations)
         file.write('* model command line\n')
         file.write("{}\n".format(run_file))
         file.write('* model input/output\n')
@@ -153,6 +327,16 @@ def write_pest_pst_file(calibration_folder, simulation_folder, parameters, simul
             file.write('{}.ins	{}\n'.format(objective_variable, file_dict[objective_variable]))
         file.write('* prior information\n')
 
+def write_pest_observation_data(file, combined_observations, chunk_size=100000):
+    for observations in combined_observations:
+        for start in range(0, len(observations["value"]), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            file.write("".join(['%-12s\t%12.4e\t%f\t%s\n' % ('%s_%d_%d' % (observations["prefix"], i, j), v, w, observations["group"])
+                                for i, j, v, w in zip(observations["time_id"][chunk].tolist(),
+                                                      observations["depth_id"][chunk].tolist(),
+                                                      observations["value"][chunk].tolist(),
+                                                      observations["weight"][chunk].tolist())]))
+
 def write_pest_tpl_file(calibration_folder, simulation_folder, parameters, simulation):
     if simulation == "simstrat":
         par_files = [file for file in os.listdir(simulation_folder) if file.endswith(".par")]
@@ -213,34 +397,49 @@ def write_pest_ins_file(calibration_folder, calibration_options, simulation, obs
             file.write('pif @\n')
             if simulation == "simstrat":
                 file.write('l1\n')
-                for i, t in enumerate(times):
-                    if t in df.index:
-                        strf = 'l1'
-                        df_t = df.loc[t]
-                        for j, d in enumerate(depths_desc):
-                            if d in list_from_selection(df_t['depth']):
-                                if isinstance(df_t, pd.DataFrame):
-                                    row = df_t[df_t['depth'] == d].iloc[0]
-                                else:
-                                    row = df_t
-                                strf = strf + ' @,@ !%s_%d_%d!' % (objective_variable[0], i, j)
-                                combined_observations.append({
-                                    'id': f"{objective_variable[0]}_{i}_{j}",
-                                    'value': row["value"],
-                                    'weight': row["weight"],
-                                    'group': objective_variable
-                                })
-                            else:
-                                strf = strf + ' @,@'
-                        if len(strf) > 2000:
-                            raise ValueError("Instruction file .ins: line exceeds 2000 characters - reduce the number of depths in the observations file.")
-                        file.write(strf + '\n')
+                grid = align_observations(df, times, depths_desc)
+                prefix = objective_variable[0]
+                starts = np.flatnonzero(np.r_[True, grid["time_id"][1:] != grid["time_id"][:-1]])
+                ends = np.r_[starts[1:], len(grid["time_id"])]
+                for start, end in zip(starts, ends):
+                    i = grid["time_id"][start]
+                    strf = 'l1'
+                    previous = -1
+                    for j in grid["depth_id"][start:end]:
+                        strf = strf + ' @,@' * (j - previous - 1) + ' @,@ !%s_%d_%d!' % (prefix, i, j)
+                        previous = j
+                    strf = strf + ' @,@' * (len(depths_desc) - previous - 1)
+                    if len(strf) > 2000:
+                        raise ValueError("Instruction file .ins: line exceeds 2000 characters - reduce the number of depths in the observations file.")
+                    file.write(strf + '\n')
+                combined_observations.append({
+                    'prefix': prefix,
+                    'group': objective_variable,
+                    'time_id': grid["time_id"],
+                    'depth_id': grid["depth_id"],
+                    'value': grid["value"],
+                    'weight': grid["weight"]
+                })
             else:
                 raise ValueError("write_pest_ins_file not implemented for simulation: {}".format(simulation))
-    combined_observations = pd.DataFrame(combined_observations, columns=['id', 'value', 'weight', 'group'])
     return combined_observations
 
 
+def align_observations(df, times, depths):
+    time_id = pd.Index(times).get_indexer(df.index)
+    depth_id = pd.Index(depths).get_indexer(df["depth"])
+    grid = pd.DataFrame({
+        "time_id": time_id,
+        "depth_id": depth_id,
+        "value": df["value"].to_numpy(),
+        "weight": df["weight"].to_numpy()
+    })
+    grid = grid[(grid["time_id"] >= 0) & (grid["depth_id"] >= 0)]
+    grid = grid.drop_duplicates(subset=["time_id", "depth_id"], keep="first")
+    grid = grid.sort_values(["time_id", "depth_id"], kind="stable")
+    return {key: grid[key].to_numpy() for key in grid.columns}
+
+
 def weighted_rms(g):
     return np.sqrt(g["Residual2*Weight"].sum() / g["Weight"].sum())
 
@@ -306,7 +505,10 @@ def pest_local_cleanup():
     else:
         os.system('taskkill /F /IM pest_hp.exe /T 2>nul')
 
-def pest_local(calibration_options, calibration_folder, execute):
+def link_inputs(calibration_options):
+    return "link_inputs" in calibration_options and calibration_options["link_inputs"]
+
+def pest_local(calibration_options, calibration_folder, execute, switches=[], seed_file=None):
     if "local_compilation_pest" not in calibration_options:
         raise ValueError("local_compilation_pest must be defined in calibration_options to run PEST without docker")
     if "local_compilation_agent" not in calibration_options:
@@ -315,8 +517,13 @@ def pest_local(calibration_options, calibration_folder, execute):
     proc = []
     ip_address = socket.gethostbyname(socket.gethostname())
     calibration_folder = os.path.abspath(calibration_folder)
-    cmd = [calibration_options["local_compilation_pest"], "pest.pst", "/h", ":{}".format(calibration_options["port"])]
-    p = subprocess.Popen(cmd, cwd=calibration_folder)
+    cmd = [calibration_options["local_compilation_pest"], "pest.pst"] + switches + ["/h", ":{}".format(calibration_options["port"])]
+    if seed_file is None:
+        p = subprocess.Popen(cmd, cwd=calibration_folder)
+    else:
+        p = subprocess.Popen(cmd, cwd=calibration_folder, stdin=subprocess.PIPE, universal_newlines=True)
+        p.stdin.write(seed_file + "\n")
+        p.stdin.close()
     proc.append(p)
     for i in range(calibration_options["agents"]):
         agent_dir = os.path.join(calibration_folder, f"agent{i}")
@@ -327,16 +534,27 @@ def pest_local(calibration_options, calibration_folder, execute):
                     shutil.copy(os.path.join(calibration_folder, file), agent_dir)
                 except FileNotFoundError:
                     continue
+        if link_inputs(calibration_options):
+            link_simstrat_inputs(os.path.join(calibration_folder, "inputs"), agent_dir, method="hardlink")
+        results_dir = os.path.join(agent_dir, "Results")
         if platform.system() == 'Linux':
             with open(os.path.join(agent_dir, "run.sh"), 'w') as file:
                 file.write('#!/bin/bash\n')
-                file.write('cp -r "{}"/* "{}"/\n'.format(os.path.join(calibration_folder, "inputs"), agent_dir))
+                if link_inputs(calibration_options):
+                    file.write('rm -rf "{}"\n'.format(results_dir))
+                    file.write('mkdir -p "{}"\n'.format(results_dir))
+                else:
+                    file.write('cp -r "{}"/* "{}"/\n'.format(os.path.join(calibration_folder, "inputs"), agent_dir))
                 file.write(execute.format(calibration_folder=agent_dir))
             os.chmod(os.path.join(agent_dir, "run.sh"), 0o755)
         else:
             with open(os.path.join(agent_dir, "run.bat"), 'w') as file:
-                file.write(
-                    'xcopy "{}" "{}" /E /I /Y\n'.format(os.path.join(calibration_folder, "inputs", "*"), agent_dir))
+                if link_inputs(calibration_options):
+                    file.write('if exist "{0}" rmdir /S /Q "{0}"\n'.format(results_dir))
+                    file.write('mkdir "{}"\n'.format(results_dir))
+                else:
+                    file.write(
+                        'xcopy "{}" "{}" /E /I /Y\n'.format(os.path.join(calibration_folder, "inputs", "*"), agent_dir))
                 file.write(execute.format(calibration_folder=agent_dir))
         cmd = [calibration_options["local_compilation_agent"], "pest.pst", "/h", "{}:{}".format(ip_address, calibration_options["port"])]
         p = subprocess.Popen(cmd, cwd=agent_dir)
@@ -0,0 +1,187 @@
+import os
+import re
+import json
+import threading
+import numpy as np
+from datetime import datetime
+
+ITERATION = re.compile(r"OPTIMI[SZ]ATION ITERATION NO\.\s*:\s*(\d+)", re.IGNORECASE)
+STARTING_PHI = re.compile(r"Starting phi for this iteration\s*:\s*([-+\d.Ee]+)", re.IGNORECASE)
+LOWEST_PHI = re.compile(r"Lowest phi this iteration\s*:\s*([-+\d.Ee]+)", re.IGNORECASE)
+MODEL_CALLS = re.compile(r"Model calls so far\s*:\s*(\d+)", re.IGNORECASE)
+RUN_COMPLETED = re.compile(r":-\s*run\s+(\d+)\s+completed\s+on\s+agent\s+with\s+id\s*=\s*(\d+)"
+                           r"(?:\s*;\s*run\s+time\s*=\s*([\d.]+)\s*(sec|min|hour))?", re.IGNORECASE)
+RUN_FAILED = re.compile(r":-\s*run\s+(\d+)\s+failed\s+on\s+agent\s+with\s+id\s*=\s*(\d+)", re.IGNORECASE)
+
+
+class FileTail(object):
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.partial = b""
+
+    def read_lines(self):
+        if not os.path.exists(self.path):
+            return []
+        size = os.path.getsize(self.path)
+        if size < self.offset:
+            self.offset = 0
+            self.partial = b""
+        if size == self.offset:
+            return []
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        self.offset = self.offset + len(data)
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        return [line.decode("utf-8", errors="replace").rstrip("\r") for line in lines]
+
+
+class PestMonitor(threading.Thread):
+    def __init__(self, calibration_folder, log, interval=30, case="pest"):
+        super(PestMonitor, self).__init__(daemon=True)
+        self.calibration_folder = calibration_folder
+        self.log = log
+        self.interval = interval
+        self.output = os.path.join(calibration_folder, "{}_progress.jsonl".format(case))
+        self.tails = {ext: FileTail(os.path.join(calibration_folder, "{}.{}".format(case, ext)))
+                      for ext in ["rec", "rmr", "iobj", "ipar"]}
+        self.headers = {}
+        self.stopped = threading.Event()
+        self.state = {
+            "iteration": None,
+            "phi": None,
+            "phi_by_iteration": {},
+            "parameters": {},
+            "completed_runs": 0,
+            "reported_runs": 0,
+            "failed_runs": 0,
+            "agents": {}
+        }
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        self.poll()
+
+    def poll(self):
+        changed = False
+        for line in self.tails["rec"].read_lines():
+            changed = self.parse_rec_line(line) or changed
+        for line in self.tails["rmr"].read_lines():
+            changed = self.parse_rmr_line(line) or changed
+        for ext in ["iobj", "ipar"]:
+            for line in self.tails[ext].read_lines():
+                changed = self.parse_csv_line(ext, line) or changed
+        if changed:
+            self.write_record()
+        return changed
+
+    def parse_rec_line(self, line):
+        match = ITERATION.search(line)
+        if match:
+            self.state["iteration"] = int(match.group(1))
+            return True
+        for pattern in [STARTING_PHI, LOWEST_PHI]:
+            match = pattern.search(line)
+            if match:
+                self.set_phi(self.state["iteration"], float(match.group(1)))
+                return True
+        match = MODEL_CALLS.search(line)
+        if match:
+            self.state["reported_runs"] = max(self.state["reported_runs"], int(match.group(1)))
+            return True
+        return False
+
+    def parse_rmr_line(self, line):
+        match = RUN_COMPLETED.search(line)
+        if match:
+            self.state["completed_runs"] += 1
+            agent = self.agent(match.group(2))
+            agent["runs"] += 1
+            if match.group(3) is not None:
+                seconds = float(match.group(3))
+                unit = (match.group(4) or "sec").lower()
+                if unit == "min":
+                    seconds = seconds * 60
+                elif unit == "hour":
+                    seconds = seconds * 3600
+                agent["run_times"].append(seconds)
+            return True
+        match = RUN_FAILED.search(line)
+        if match:
+            self.state["failed_runs"] += 1
+            self.agent(match.group(2))["failed"] += 1
+            return True
+        return False
+
+    def parse_csv_line(self, ext, line):
+        values = [v.strip() for v in line.split(",")]
+        if len(values) < 2 or values[0] == "":
+            return False
+        if ext not in self.headers:
+            self.headers[ext] = [v.lower() for v in values]
+            return False
+        row = dict(zip(self.headers[ext], values))
+        try:
+            iteration = int(float(row["iteration"]))
+        except (KeyError, ValueError):
+            return False
+        if ext == "iobj":
+            for key in ["total_phi", "measurement_phi", "phi"]:
+                if key in row:
+                    self.set_phi(iteration, float(row[key]))
+                    break
+            if "model_runs_completed" in row:
+                self.state["reported_runs"] = max(self.state["reported_runs"], int(float(row["model_runs_completed"])))
+        else:
+            self.state["parameters"] = {k: float(v) for k, v in row.items() if k != "iteration"}
+        self.state["iteration"] = max(iteration, self.state["iteration"] or 0)
+        return True
+
+    def set_phi(self, iteration, phi):
+        if iteration is None:
+            self.state["phi"] = phi
+            return
+        previous = self.state["phi_by_iteration"].get(str(iteration))
+        self.state["phi_by_iteration"][str(iteration)] = phi if previous is None else min(previous, phi)
+        self.state["phi"] = self.state["phi_by_iteration"][str(iteration)]
+
+    def agent(self, agent):
+        if agent not in self.state["agents"]:
+            self.state["agents"][agent] = {"runs": 0, "failed": 0, "run_times": []}
+        return self.state["agents"][agent]
+
+    def summary(self):
+        agents = {}
+        for agent, values in self.state["agents"].items():
+            run_times = values["run_times"]
+            agents[agent] = {
+                "runs": values["runs"],
+                "failed": values["failed"],
+                "mean_run_time": float(np.mean(run_times)) if len(run_times) > 0 else None,
+                "max_run_time": float(np.max(run_times)) if len(run_times) > 0 else None
+            }
+        return {
+            "time": datetime.now().isoformat(),
+            "iteration": self.state["iteration"],
+            "phi": self.state["phi"],
+            "phi_by_iteration": self.state["phi_by_iteration"],
+            "parameters": self.state["parameters"],
+            "model_runs": max(self.state["completed_runs"], self.state["reported_runs"]),
+            "failed_runs": self.state["failed_runs"],
+            "agents": agents
+        }
+
+    def write_record(self):
+        record = self.summary()
+        with open(self.output, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.log.info("PEST iteration {}: phi {}, {} model runs, {} failed".format(
+            record["iteration"], record["phi"], record["model_runs"], record["failed_runs"]), indent=2)
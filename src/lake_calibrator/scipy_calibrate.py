@@ -1,13 +1,22 @@
 import os
+import json
 import shutil
+import numpy as np
+import tempfile
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-from scipy.optimize import minimize
-from .simstrat import edit_par_file, copy_simstrat_inputs, simstrat_rms, simstrat_max_depth, set_simstrat_outputs
-from .functions import run_subprocess, read_observation_data, datetime_from_days, days_since_year
-
-iteration = 1
-run = 0
+from scipy.optimize import minimize, differential_evolution
+from scipy.stats import qmc
+from .simstrat import edit_par_file, copy_simstrat_inputs, simstrat_rms, simstrat_simulated, PartialObjective, simstrat_max_depth, set_simstrat_outputs, compile_observation_index, link_simstrat_inputs
+from .functions import run_subprocess, folder_lock, read_observation_data, datetime_from_days, days_since_year
+from .cache import EvaluationCache, hash_inputs
+from .executor import get_executor, EvaluationAborted
+from .parallel_simplex import parallel_nelder_mead
+from .surrogate import surrogate_minimize, read_surrogate_inputs
+from .distributed import start_coordinator, register_base, close_coordinators, submit_job
+from .timing import StageTimer, write_timing_record, summarise_timings, bytes_written
 
 def scipy_calibrate(args, log):
     log.info("Calibrating {} with Scipy {}".format(args["simulation"], args["calibration_options"]["method"]))
@@ -19,29 +28,37 @@ def scipy_calibrate(args, log):
     if "Calibration.par" not in args["execute"]:
         raise ValueError('Execute command in argument file should contain "Calibration.par" NOT the name of your par file.')
 
+    clean_calibration_folder(args["calibration_folder"], log)
+    start_coordinator(args, log)
+
     if args["simulation"] == "simstrat":
-        base_folder = os.path.join(args["calibration_folder"], "base")
-        copy_simstrat_inputs(args["simulation_folder"], base_folder)
-        config = edit_par_file(base_folder, initial=True)
-        if "burn_in_days" in args["calibration_options"]:
-            log.info('Using burn in period of {} days'.format(args["calibration_options"]["burn_in_days"]), indent=2)
-            start_date = datetime_from_days(config["Simulation"]["Start d"], config["Simulation"]["Reference year"]) + relativedelta(days=args["calibration_options"]["burn_in_days"])
-        else:
-            log.info('"burn_in_days" not defined in calibration_options, using default of 365 days', indent=2)
-            start_date = datetime_from_days(config["Simulation"]["Start d"], config["Simulation"]["Reference year"]) + relativedelta(years=1)
-        end_date = datetime_from_days(config["Simulation"]["End d"], config["Simulation"]["Reference year"])
-        max_depth = simstrat_max_depth(args["simulation_folder"], config["Input"]["Morphology"])
-        times, depths, observations = read_observation_data(args["calibration_options"], args["observations"], start_date, end_date, max_depth)
-        if times[-1] + relativedelta(days=1) < end_date:
-            log.info("Editing PAR file to stop simulation at last observation", indent=1)
-            end_date = days_since_year(times[-1] + relativedelta(days=1), config["Simulation"]["Reference year"])
-            edit_par_file(base_folder, end_date=end_date)
-        log.info("Setting Simstrat output files", indent=1)
-        set_simstrat_outputs(base_folder, times, depths, config["Simulation"]["Reference year"])
+        observation_index = prepare_simstrat(args, log)
         fun = simstrat304_iterator
     else:
         raise ValueError("Not implemented for {}".format(args["simulation"]))
 
+    cache = evaluation_cache(args, parameter_names, observation_index, log)
+
+    refresh = spin_up_refresh(args["calibration_options"])
+    if refresh and cache is not None:
+        log.info("Refreshing the spin up every {} iterations, evaluation cache disabled".format(refresh), indent=1)
+        cache = None
+
+    if "screening" in args["calibration_options"]:
+        x0 = screen_parameters(args, log, x0, bounds, parameter_names, observation_index, cache)
+
+    iteration = 1
+    start_time = datetime.now()
+
+    def iteration_information(p, convergence=None):
+        nonlocal iteration
+        log.info("Iteration {}".format(iteration), indent=1)
+        if refresh and iteration > 1 and (iteration - 1) % refresh == 0:
+            best = read_best_run(args["calibration_folder"])
+            if best is not None:
+                run_spin_up(args, log, parameter_names, best["parameters"])
+        iteration += 1
+
     if args["calibration_options"]["method"] == "Nelder-Mead":
         options = {
             "maxfev": args["calibration_options"]["maxfev"],
@@ -49,63 +66,385 @@ def scipy_calibrate(args, log):
             "fatol": args["calibration_options"]["fatol"],
             "xatol": args["calibration_options"]["xatol"]
         }
+        iteration_information([])
+        results = minimize(
+            fun=fun,
+            x0=x0,
+            args=(args, log, observation_index, cache),
+            method=args["calibration_options"]["method"],
+            bounds=bounds,
+            options=options,
+            callback=iteration_information
+        )
+    elif args["calibration_options"]["method"] == "parallel-Nelder-Mead":
+        calib = args["calibration_options"]
+        workers = calib["workers"] if "workers" in calib else 4
+        log.info("Evaluating simplex candidates on {} workers".format(workers), indent=1)
+        iteration_information([])
+        results = parallel_nelder_mead(
+            fun,
+            x0,
+            args=(args, log, observation_index, cache),
+            bounds=bounds,
+            maxfev=calib["maxfev"] if "maxfev" in calib else None,
+            maxiter=calib["maxiter"] if "maxiter" in calib else None,
+            fatol=calib["fatol"] if "fatol" in calib else 1e-4,
+            xatol=calib["xatol"] if "xatol" in calib else 1e-4,
+            workers=workers,
+            callback=iteration_information,
+            early_abort="early_abort" in calib and bool(calib["early_abort"])
+        )
+        log.info("{} evaluations used by the simplex, {} simulated".format(results.nfev, results.nruns), indent=1)
+    elif args["calibration_options"]["method"] == "surrogate":
+        calib = args["calibration_options"]
+        workers = calib["workers"] if "workers" in calib else 4
+        state_file = os.path.join(args["calibration_folder"], "surrogate.json")
+        warm_start = calib["warm_start"] if "warm_start" in calib else state_file
+        inputs_hash = cache.inputs_hash if cache is not None else hash_inputs(
+            os.path.join(args["calibration_folder"], "base"), parameter_names, observation_index, args["execute"])
+        if os.path.exists(warm_start) and read_surrogate_inputs(warm_start) != inputs_hash:
+            log.warning("Ignoring {}, it was created with different model inputs or observations".format(warm_start), indent=1)
+            warm_start = None
+        elif os.path.exists(warm_start):
+            log.info("Warm starting surrogate from {}".format(warm_start), indent=1)
+        log.info("Evaluating batches of {} on {} workers".format(calib["batch_size"] if "batch_size" in calib else workers, workers), indent=1)
+        iteration_information([])
+        results = surrogate_minimize(
+            fun,
+            x0,
+            args=(args, log, observation_index, cache),
+            bounds=bounds,
+            parameter_names=parameter_names,
+            maxfev=calib["maxfev"] if "maxfev" in calib else 100,
+            initial_points=calib["initial_points"] if "initial_points" in calib else None,
+            batch_size=calib["batch_size"] if "batch_size" in calib else workers,
+            workers=workers,
+            xi=calib["xi"] if "xi" in calib else 0.0,
+            seed=calib["seed"] if "seed" in calib else None,
+            state_file=state_file,
+            warm_start=warm_start,
+            inputs_hash=inputs_hash,
+            callback=iteration_information
+        )
+    elif args["calibration_options"]["method"] == "differential_evolution":
+        calib = args["calibration_options"]
+        workers = calib["workers"] if "workers" in calib else os.cpu_count()
+        maxiter = calib["maxiter"] if "maxiter" in calib else 100
+        log.info("Evaluating populations on {} workers".format(workers), indent=1)
+        iteration_information([])
+        results = differential_evolution(
+            fun,
+            bounds,
+            args=(args, log, observation_index, cache),
+            x0=x0,
+            maxiter=maxiter,
+            popsize=calib["popsize"] if "popsize" in calib else 15,
+            tol=calib["tol"] if "tol" in calib else 0.01,
+            seed=calib["seed"] if "seed" in calib else None,
+            disp=calib["disp"] if "disp" in calib else False,
+            polish=calib["polish"] if "polish" in calib else False,
+            init=calib["init"] if "init" in calib else "latinhypercube",
+            updating="deferred",
+            workers=workers,
+            callback=iteration_information
+        )
+        if not results.success and results.nit >= maxiter:
+            log.warning("Differential evolution reached maxiter before converging, using best population member", indent=1)
+            results.success = True
     else:
         raise ValueError("Not implemented for {}".format(args["calibration_options"]["method"]))
 
-    def iteration_information(p):
-        global iteration
-        log.info("Iteration {}".format(iteration), indent=1)
-        iteration += 1
+    close_coordinators()
+    if not results.success:
+        raise ValueError("Optimizer existed unsuccessfully: {}".format(results.message))
+    timings = summarise_timings(args["calibration_folder"], (datetime.now() - start_time).total_seconds(),
+                                since=start_time.isoformat())
 
-    iteration_information([])
+    error = final_simulation(args, log, parameter_names, results.x, observation_index)
+
+    return {
+        "parameters": dict(zip(parameter_names, results["x"])),
+        "error": error,
+        "timings": timings
+    }
 
-    results = minimize(
-        fun=fun,
-        x0=x0,
-        args=(args, log),
-        method=args["calibration_options"]["method"],
-        bounds=bounds,
-        options=options,
-        callback=iteration_information
-    )
 
-    if not results.success:
-        raise ValueError("Optimizer existed unsuccessfully: {}".format(results.message))
+def clean_calibration_folder(calibration_folder, log):
+    for item in os.listdir(calibration_folder):
+        if item.startswith("run_") or item == "final":
+            log.info("Removing incomplete run folder {}".format(item), indent=1)
+            shutil.rmtree(os.path.join(calibration_folder, item))
+        elif item == "best.lock":
+            os.rmdir(os.path.join(calibration_folder, item))
+        elif item.startswith("best.json"):
+            os.remove(os.path.join(calibration_folder, item))
 
-    log.info("Running final simulation with optimal parameters", indent=1)
+def prepare_simstrat(args, log, base="base", years=None):
+    base_folder = os.path.join(args["calibration_folder"], base)
+    copy_simstrat_inputs(args["simulation_folder"], base_folder)
+    config = edit_par_file(base_folder, initial=True)
+    if "burn_in_days" in args["calibration_options"]:
+        log.info('Using burn in period of {} days'.format(args["calibration_options"]["burn_in_days"]), indent=2)
+        start_date = datetime_from_days(config["Simulation"]["Start d"], config["Simulation"]["Reference year"]) + relativedelta(days=args["calibration_options"]["burn_in_days"])
+    else:
+        log.info('"burn_in_days" not defined in calibration_options, using default of 365 days', indent=2)
+        start_date = datetime_from_days(config["Simulation"]["Start d"], config["Simulation"]["Reference year"]) + relativedelta(years=1)
+    end_date = datetime_from_days(config["Simulation"]["End d"], config["Simulation"]["Reference year"])
+    if years is not None:
+        if start_date + relativedelta(years=years) >= end_date:
+            shutil.rmtree(base_folder)
+            return None
+        end_date = start_date + relativedelta(years=years)
+        log.info("Stopping simulation after {} years of observations".format(years), indent=1)
+        edit_par_file(base_folder, end_date=days_since_year(end_date, config["Simulation"]["Reference year"]))
+    max_depth = simstrat_max_depth(args["simulation_folder"], config["Input"]["Morphology"])
+    observations = [dict(observation) for observation in args["observations"]]
+    times, depths, observations = read_observation_data(args["calibration_options"], observations, start_date, end_date, max_depth)
+    if times[-1] + relativedelta(days=1) < end_date:
+        log.info("Editing PAR file to stop simulation at last observation", indent=1)
+        end_date = days_since_year(times[-1] + relativedelta(days=1), config["Simulation"]["Reference year"])
+        edit_par_file(base_folder, end_date=end_date)
+    log.info("Setting Simstrat output files", indent=1)
+    set_simstrat_outputs(base_folder, times, depths, config["Simulation"]["Reference year"])
+    if "spin_up" in args["calibration_options"] and args["calibration_options"]["spin_up"]:
+        spin_up_days = days_since_year(start_date, config["Simulation"]["Reference year"])
+        if base == "base":
+            with open(os.path.join(args["calibration_folder"], "spin_up.json"), "w") as f:
+                json.dump({"start": config["Simulation"]["Start d"], "end": spin_up_days}, f)
+            run_spin_up(args, log)
+        else:
+            link_spin_up(os.path.join(args["calibration_folder"], "base"), base_folder, args["calibration_options"])
+        edit_par_file(base_folder, simulation={"Start d": spin_up_days, "Use text restart": True})
+    log.info("Compiling observation index", indent=1)
+    observation_index = compile_observation_index(args["calibration_options"]["objective_variables"],
+                                                  args["calibration_options"]["objective_weights"],
+                                                  observations)
+    register_base(args, base, observation_index)
+    return observation_index
+
+def spin_up_snapshot(calibration_options):
+    spin_up = calibration_options["spin_up"] if isinstance(calibration_options["spin_up"], dict) else {}
+    return spin_up["snapshot"] if "snapshot" in spin_up else os.path.join("Results", "simulation-snapshot.dat")
+
+def spin_up_refresh(calibration_options):
+    if "spin_up" not in calibration_options or not isinstance(calibration_options["spin_up"], dict):
+        return None
+    return calibration_options["spin_up"]["refresh"] if "refresh" in calibration_options["spin_up"] else None
+
+def run_spin_up(args, log, parameter_names=[], parameter_values=[]):
+    snapshot = spin_up_snapshot(args["calibration_options"])
+    with open(os.path.join(args["calibration_folder"], "spin_up.json")) as f:
+        period = json.load(f)
+    base_folder = os.path.join(args["calibration_folder"], "base")
+    folder = os.path.abspath(os.path.join(args["calibration_folder"], "spin_up"))
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    link_simstrat_inputs(base_folder, folder, method="hardlink")
+    if os.path.exists(os.path.join(folder, snapshot)):
+        os.remove(os.path.join(folder, snapshot))
+    log.info("Running spin up from day {} to {}".format(period["start"], period["end"]), indent=1)
+    edit_par_file(folder, parameter_names=parameter_names, parameter_values=parameter_values, simulation={
+        "Start d": period["start"], "End d": period["end"], "Save text restart": True, "Use text restart": False})
+    run_subprocess(args["execute"].format(calibration_folder=folder), cwd=folder,
+                   executor=get_executor(args["calibration_options"], args["calibration_folder"]))
+    if not os.path.exists(os.path.join(folder, snapshot)):
+        raise ValueError("Spin up did not write a restart file to {}".format(os.path.join(folder, snapshot)))
+    os.makedirs(os.path.dirname(os.path.join(base_folder, snapshot)), exist_ok=True)
+    shutil.copy2(os.path.join(folder, snapshot), os.path.join(base_folder, snapshot + ".tmp"))
+    os.replace(os.path.join(base_folder, snapshot + ".tmp"), os.path.join(base_folder, snapshot))
+    shutil.rmtree(folder)
+
+def link_spin_up(base_folder, folder, calibration_options):
+    snapshot = spin_up_snapshot(calibration_options)
+    if os.path.exists(os.path.join(folder, snapshot)):
+        return
+    os.makedirs(os.path.dirname(os.path.join(folder, snapshot)), exist_ok=True)
+    try:
+        os.link(os.path.join(base_folder, snapshot), os.path.join(folder, snapshot))
+    except OSError:
+        shutil.copy2(os.path.join(base_folder, snapshot), os.path.join(folder, snapshot))
+
+def evaluation_cache(args, parameter_names, observation_index, log, base="base"):
+    if "cache" in args["calibration_options"] and not args["calibration_options"]["cache"]:
+        return None
+    base_folder = os.path.join(args["calibration_folder"], base)
+    inputs_hash = hash_inputs(base_folder, parameter_names, observation_index, args["execute"])
+    cache = EvaluationCache(os.path.join(os.path.abspath(args["calibration_folder"]), "evaluations.sqlite"), inputs_hash)
+    log.info("Evaluation cache contains {} evaluations for these inputs".format(cache.count()), indent=1)
+    return cache
+
+def final_simulation(args, log, parameter_names, parameter_values, observation_index):
     final_folder = os.path.abspath(os.path.join(args["calibration_folder"], "final"))
-    shutil.copytree(os.path.join(args["calibration_folder"], "base"), final_folder)
-    config = edit_par_file(final_folder, parameter_names=parameter_names, parameter_values=results.x)
-    reference_year = config["Simulation"]["Reference year"]
-    run_subprocess(args["execute"].format(calibration_folder=final_folder), cwd=final_folder)
+    best = read_best_run(args["calibration_folder"])
+    if best is not None and best["folder"] is not None and np.array_equal(best["parameters"], parameter_values):
+        log.info("Reusing output of best evaluation {} as final simulation".format(best["folder"]), indent=1)
+        os.rename(os.path.join(args["calibration_folder"], best["folder"]), final_folder)
+        error = best["error"]
+    else:
+        log.info("Running final simulation with optimal parameters", indent=1)
+        if best is not None and best["folder"] is not None:
+            shutil.rmtree(os.path.join(args["calibration_folder"], best["folder"]))
+        shutil.copytree(os.path.join(args["calibration_folder"], "base"), final_folder)
+        config = edit_par_file(final_folder, parameter_names=parameter_names, parameter_values=parameter_values)
+        reference_year = config["Simulation"]["Reference year"]
+        run_subprocess(args["execute"].format(calibration_folder=final_folder), cwd=final_folder,
+                       executor=get_executor(args["calibration_options"], args["calibration_folder"]))
+        error = simstrat_rms(observation_index, reference_year, os.path.join(final_folder, "Results"),
+                             **output_reader_options(args["calibration_options"]))
+    if best is not None:
+        os.remove(os.path.join(args["calibration_folder"], "best.json"))
+    return error
+
+def screen_parameters(args, log, x0, bounds, parameter_names, observation_index, cache):
     calib = args["calibration_options"]
-    error = simstrat_rms(calib["objective_variables"], calib["objective_weights"], args["observations"], reference_year,
-                         os.path.join(final_folder, "Results"))
+    screening = calib["screening"]
+    years = screening["years"] if "years" in screening else 3
+    evaluations = screening["evaluations"] if "evaluations" in screening else 10 * len(x0)
+    promote = screening["promote"] if "promote" in screening else 5
+    workers = screening["workers"] if "workers" in screening else (calib["workers"] if "workers" in calib else os.cpu_count())
+    log.info("Preparing {} year screening simulation".format(years), indent=1)
+    screening_index = prepare_simstrat(args, log, base="base_screening", years=years)
+    if screening_index is None:
+        log.info("Observation period is not longer than the screening window, skipping screening", indent=1)
+        return x0
+    screening_cache = evaluation_cache(args, parameter_names, screening_index, log, base="base_screening")
+    lower, upper = np.array(bounds, dtype=float).T
+    sample = qmc.LatinHypercube(d=len(x0), seed=calib["seed"] if "seed" in calib else None).random(evaluations - 1)
+    candidates = np.vstack([x0, lower + sample * (upper - lower)])
+    log.info("Screening {} parameter sets on {} workers".format(len(candidates), workers), indent=1)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        n = len(candidates)
+        screened = list(pool.map(partial(simstrat304_iterator, base="base_screening", keep=False), candidates,
+                                 [args] * n, [log] * n, [screening_index] * n, [screening_cache] * n))
+        order = np.argsort(screened, kind="stable")[:promote]
+        log.info("Promoting {} parameter sets to the full period".format(len(order)), indent=1)
+        n = len(order)
+        full = list(pool.map(simstrat304_iterator, candidates[order], [args] * n, [log] * n, [observation_index] * n,
+                             [cache] * n))
+    best = order[int(np.argmin(full))]
+    log.info("Starting from screened parameters [{}] with error {}".format(
+        ", ".join(map(str, candidates[best])), min(full)), indent=1)
+    return candidates[best].tolist()
+
+def simstrat304_iterator(parameter_values, args, log, observation_index, cache=None, base="base", keep=True, threshold=None):
+    return simstrat304_run(parameter_values, args, log, observation_index, cache=cache, base=base, keep=keep,
+                           threshold=threshold)[0]["overall"]
 
+def output_reader_options(calibration_options):
+    options = calibration_options["output_reader"] if "output_reader" in calibration_options else {}
     return {
-        "parameters": dict(zip(parameter_names, results["x"])),
-        "error": error
+        "dtype": np.dtype(options["dtype"]) if "dtype" in options else np.float64,
+        "chunk_rows": options["chunk_rows"] if "chunk_rows" in options else None
     }
 
-def simstrat304_iterator(parameter_values, args, log):
-    log.info("Running: [{}]".format(", ".join(map(str, parameter_values))), indent=2)
-    global run
-    folder = os.path.abspath(os.path.join(args["calibration_folder"], "{}_{}".format(iteration, run)))
-    shutil.copytree(os.path.join(args["calibration_folder"], "base"), folder)
+def early_abort_options(calibration_options, threshold=None):
+    if "early_abort" not in calibration_options or not calibration_options["early_abort"]:
+        return None, 5, np.inf
+    options = calibration_options["early_abort"] if isinstance(calibration_options["early_abort"], dict) else {}
+    penalty = None if threshold is not None else (options["penalty"] if "penalty" in options else np.inf)
+    if threshold is None and "threshold" in options:
+        threshold = options["threshold"]
+    if threshold is None or not np.isfinite(threshold):
+        threshold = None
+    return threshold, options["interval"] if "interval" in options else 5, penalty
+
+def simstrat304_run(parameter_values, args, log, observation_index, cache=None, base="base", keep=True, threshold=None):
+    timer = StageTimer()
+    if cache is not None:
+        with timer.stage("cache"):
+            error = cache.get(parameter_values)
+        if error is not None:
+            log.info("Cached: [{}] Error: {}".format(", ".join(map(str, parameter_values)), error["overall"]), indent=2)
+            if keep:
+                keep_best_run(args["calibration_folder"], None, parameter_values, error)
+            write_timing_record(args["calibration_folder"], None, parameter_values, error["overall"], timer, cached=True)
+            return error, None
+    if "distributed" in args["calibration_options"] and args["calibration_options"]["distributed"]:
+        return simstrat304_remote(parameter_values, args, log, base, keep, threshold, cache, timer)
+    folder = tempfile.mkdtemp(prefix="run_", dir=os.path.abspath(args["calibration_folder"]))
+    log.info("Running {}: [{}]".format(os.path.basename(folder), ", ".join(map(str, parameter_values))), indent=2)
+    run_folder = args["calibration_options"]["run_folder"] if "run_folder" in args["calibration_options"] else "hardlink"
+    with timer.stage("copy_inputs"):
+        link_simstrat_inputs(os.path.join(args["calibration_folder"], base), folder, method=run_folder)
+        if "spin_up" in args["calibration_options"] and args["calibration_options"]["spin_up"]:
+            link_spin_up(os.path.join(args["calibration_folder"], base), folder, args["calibration_options"])
     parameter_names = [parameter["name"] for parameter in args["parameters"]]
-    config = edit_par_file(folder, parameter_names=parameter_names, parameter_values=parameter_values)
+    with timer.stage("edit_par_file"):
+        config = edit_par_file(folder, parameter_names=parameter_names, parameter_values=parameter_values)
     reference_year = config["Simulation"]["Reference year"]
-    run_subprocess(args["execute"].format(calibration_folder=folder), cwd=folder)
+    threshold, interval, penalty = early_abort_options(args["calibration_options"], threshold)
+    partial = None if threshold is None else PartialObjective(observation_index, reference_year, os.path.join(folder, "Results"))
+    aborted = False
+    with timer.stage("model"):
+        try:
+            run_subprocess(args["execute"].format(calibration_folder=folder), cwd=folder,
+                           executor=get_executor(args["calibration_options"], args["calibration_folder"]),
+                           abort=None if partial is None else lambda: partial.update() > threshold, interval=interval)
+        except EvaluationAborted:
+            aborted = True
+    if aborted:
+        bound = partial.lower_bound()
+        error = {"overall": bound if penalty is None else penalty, "lower_bound": bound, "surface": None, "bottom": None,
+                 "by_depth": {}, "aborted": True}
+        with timer.stage("cleanup"):
+            shutil.rmtree(folder)
+        write_timing_record(args["calibration_folder"], os.path.basename(folder), parameter_values, error["overall"], timer)
+        log.info("Aborted {}: error above {} (at least {})".format(os.path.basename(folder), threshold, bound), indent=3)
+        return error, None
+    written = bytes_written(folder)
     calib = args["calibration_options"]
     if calib["objective_function"] == "rms":
-        error = simstrat_rms(calib["objective_variables"],
-                             calib["objective_weights"],
-                             args["observations"],
-                             reference_year,
-                             os.path.join(folder, "Results"))
+        simulated = simstrat_simulated(observation_index, reference_year, os.path.join(folder, "Results"), timer=timer,
+                                       **output_reader_options(calib))
+        error = simstrat_rms(observation_index, reference_year, os.path.join(folder, "Results"), timer=timer, simulated=simulated)
     else:
         raise ValueError("Unrecognized objective function {}".format(calib["objective_function"]))
-    shutil.rmtree(folder)
-    log.info("Error: {}".format(error["overall"]), indent=3)
-    run += 1
-    return error["overall"]
+    with timer.stage("cleanup"):
+        if not keep or not keep_best_run(args["calibration_folder"], folder, parameter_values, error):
+            shutil.rmtree(folder)
+        if cache is not None:
+            cache.put(parameter_values, error)
+    write_timing_record(args["calibration_folder"], os.path.basename(folder), parameter_values, error["overall"], timer,
+                        written=written)
+    log.info("Error {}: {}".format(os.path.basename(folder), error["overall"]), indent=3)
+    return error, simulated
+
+def simstrat304_remote(parameter_values, args, log, base, keep, threshold, cache, timer):
+    log.info("Submitting: [{}]".format(", ".join(map(str, parameter_values))), indent=2)
+    with timer.stage("remote"):
+        error, simulated = submit_job(args["calibration_options"], base, parameter_values, threshold=threshold)
+    if "aborted" in error and error["aborted"]:
+        log.info("Aborted remotely: error at least {}".format(error["lower_bound"]), indent=3)
+    else:
+        if keep:
+            keep_best_run(args["calibration_folder"], None, parameter_values, error)
+        if cache is not None:
+            cache.put(parameter_values, error)
+        log.info("Error: {}".format(error["overall"]), indent=3)
+    write_timing_record(args["calibration_folder"], None, parameter_values, error["overall"], timer)
+    return error, simulated
+
+
+def read_best_run(calibration_folder):
+    path = os.path.join(calibration_folder, "best.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def keep_best_run(calibration_folder, folder, parameter_values, error):
+    with folder_lock(os.path.join(calibration_folder, "best.lock")):
+        best = read_best_run(calibration_folder)
+        if best is not None and best["error"]["overall"] <= error["overall"]:
+            return False
+        if best is not None and best["folder"] is not None:
+            shutil.rmtree(os.path.join(calibration_folder, best["folder"]))
+        path = os.path.join(calibration_folder, "best.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({
+                "folder": None if folder is None else os.path.basename(folder),
+                "parameters": [float(v) for v in parameter_values],
+                "error": error
+            }, f)
+        os.replace(path + ".tmp", path)
+    return True
@@ -0,0 +1,156 @@
+import os
+import numpy as np
+import pandas as pd
+from functools import partial
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import qmc
+from .scipy_calibrate import clean_calibration_folder, prepare_simstrat, evaluation_cache, simstrat304_iterator
+from .distributed import start_coordinator, close_coordinators
+from .timing import summarise_timings
+
+def sensitivity_analysis(args, log):
+    calib = args["calibration_options"]
+    method = calib["method"] if "method" in calib else "morris"
+    log.info("Sensitivity analysis of {} with {}".format(args["simulation"], method))
+
+    parameter_names = [parameter["name"] for parameter in args["parameters"]]
+    lower = np.array([parameter["min"] for parameter in args["parameters"]], dtype=float)
+    upper = np.array([parameter["max"] for parameter in args["parameters"]], dtype=float)
+    if np.any(upper <= lower):
+        raise ValueError("Sensitivity analysis requires max > min for every parameter")
+    dims = len(parameter_names)
+
+    if "Calibration.par" not in args["execute"]:
+        raise ValueError('Execute command in argument file should contain "Calibration.par" NOT the name of your par file.')
+
+    clean_calibration_folder(args["calibration_folder"], log)
+    start_coordinator(args, log)
+
+    if args["simulation"] == "simstrat":
+        observation_index = prepare_simstrat(args, log)
+    else:
+        raise ValueError("Not implemented for {}".format(args["simulation"]))
+
+    cache = evaluation_cache(args, parameter_names, observation_index, log)
+
+    seed = calib["seed"] if "seed" in calib else None
+    rng = np.random.default_rng(seed)
+    if method == "morris":
+        trajectories = calib["trajectories"] if "trajectories" in calib else 10
+        levels = calib["levels"] if "levels" in calib else 4
+        log.info("Sampling {} Morris trajectories with {} levels".format(trajectories, levels), indent=1)
+        u = morris_sample(dims, trajectories, levels, rng)
+    elif method == "sobol":
+        samples = calib["samples"] if "samples" in calib else 64
+        log.info("Sampling {} Saltelli base samples".format(samples), indent=1)
+        u = saltelli_sample(dims, samples, seed)
+    else:
+        raise ValueError("Unrecognised sensitivity method {}".format(method))
+    parameter_values = lower + u * (upper - lower)
+
+    workers = calib["workers"] if "workers" in calib else os.cpu_count()
+    n = len(parameter_values)
+    log.info("Evaluating {} parameter sets on {} workers".format(n, workers), indent=1)
+    start_time = datetime.now()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        objective = np.array(list(pool.map(partial(simstrat304_iterator, keep=False, threshold=np.inf), parameter_values,
+                                           [args] * n, [log] * n, [observation_index] * n, [cache] * n)), dtype=float)
+    close_coordinators()
+    timings = summarise_timings(args["calibration_folder"], (datetime.now() - start_time).total_seconds(),
+                                since=start_time.isoformat())
+
+    samples_file = os.path.join(args["calibration_folder"], "sensitivity_samples.csv")
+    df = pd.DataFrame(parameter_values, columns=parameter_names)
+    df["objective"] = objective
+    df.to_csv(samples_file, index_label="run")
+
+    bootstrap = calib["bootstrap"] if "bootstrap" in calib else 1000
+    threshold = calib["insensitive_threshold"] if "insensitive_threshold" in calib else 0.05
+    if method == "morris":
+        indices = morris_indices(u, objective, dims, rng, bootstrap)
+        measure = indices["mu_star"] / np.max(indices["mu_star"]) if np.max(indices["mu_star"]) > 0 else indices["mu_star"]
+    else:
+        indices = sobol_indices(objective, dims, rng, bootstrap)
+        measure = indices["ST"]
+    ranking = [parameter_names[i] for i in np.argsort(-measure, kind="stable")]
+    insensitive = [name for name, value in zip(parameter_names, measure) if value < threshold]
+
+    log.info("Sensitivity ranking: {}".format(", ".join(ranking)), indent=1)
+    if len(insensitive) > 0:
+        log.info("Insensitive parameters: {}".format(", ".join(insensitive)), indent=1)
+
+    return {
+        "method": method,
+        "evaluations": n,
+        "indices": {name: {key: float(value[i]) for key, value in indices.items()} for i, name in enumerate(parameter_names)},
+        "ranking": ranking,
+        "insensitive": insensitive,
+        "samples": samples_file,
+        "timings": timings
+    }
+
+def morris_sample(dims, trajectories, levels, rng):
+    if levels < 2:
+        raise ValueError("Morris sampling requires at least 2 levels")
+    delta = (levels // 2) / (levels - 1)
+    grid = np.arange(levels - levels // 2) / (levels - 1)
+    sample = []
+    for trajectory in range(trajectories):
+        low = rng.choice(grid, dims)
+        high = rng.random(dims) < 0.5
+        x = low + delta * high
+        sample.append(x.copy())
+        for i in rng.permutation(dims):
+            high[i] = not high[i]
+            x[i] = low[i] + delta * high[i]
+            sample.append(x.copy())
+    return np.array(sample)
+
+def morris_indices(u, objective, dims, rng, bootstrap):
+    u = u.reshape(-1, dims + 1, dims)
+    objective = objective.reshape(-1, dims + 1)
+    steps = np.diff(u, axis=1)
+    changed = np.argmax(np.abs(steps), axis=2)
+    effects = np.empty((len(u), dims))
+    for t in range(len(u)):
+        effects[t, changed[t]] = np.diff(objective[t]) / steps[t, np.arange(dims), changed[t]]
+    resample = rng.integers(0, len(u), (bootstrap, len(u)))
+    return {
+        "mu": effects.mean(axis=0),
+        "mu_star": np.abs(effects).mean(axis=0),
+        "sigma": effects.std(axis=0, ddof=1) if len(u) > 1 else np.zeros(dims),
+        "mu_star_conf": 1.96 * np.abs(effects)[resample].mean(axis=1).std(axis=0)
+    }
+
+def saltelli_sample(dims, samples, seed):
+    base = qmc.Sobol(d=2 * dims, scramble=True, seed=seed).random_base2(int(np.ceil(np.log2(samples))))
+    a, b = base[:, :dims], base[:, dims:]
+    sample = []
+    for j in range(len(base)):
+        sample.append(a[j])
+        sample.append(b[j])
+        for i in range(dims):
+            ab = a[j].copy()
+            ab[i] = b[j, i]
+            sample.append(ab)
+    return np.array(sample)
+
+def sobol_estimates(f_a, f_b, f_ab):
+    variance = np.var(np.r_[f_a, f_b])
+    first = np.mean(f_b[:, None] * (f_ab - f_a[:, None]), axis=0) / variance
+    total = 0.5 * np.mean((f_a[:, None] - f_ab) ** 2, axis=0) / variance
+    return first, total
+
+def sobol_indices(objective, dims, rng, bootstrap):
+    objective = objective.reshape(-1, dims + 2)
+    f_a, f_b, f_ab = objective[:, 0], objective[:, 1], objective[:, 2:]
+    first, total = sobol_estimates(f_a, f_b, f_ab)
+    resampled = [sobol_estimates(f_a[rows], f_b[rows], f_ab[rows])
+                 for rows in rng.integers(0, len(objective), (bootstrap, len(objective)))]
+    return {
+        "S1": first,
+        "S1_conf": 1.96 * np.std([r[0] for r in resampled], axis=0),
+        "ST": total,
+        "ST_conf": 1.96 * np.std([r[1] for r in resampled], axis=0)
+    }
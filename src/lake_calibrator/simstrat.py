@@ -3,12 +3,12 @@ import json
 import shutil
 import numpy as np
 import pandas as pd
-from datetime import datetime
 from scipy.interpolate import interp1d
-from .functions import parse_observation_file, days_since_year
+from .functions import days_since_year
+from .timing import StageTimer
 
 
-def edit_par_file(folder, initial=False, parameter_names=[], parameter_values=[], end_date=False):
+def edit_par_file(folder, initial=False, parameter_names=[], parameter_values=[], end_date=False, simulation={}):
     par_files = [f for f in os.listdir(folder) if f.endswith(".par")]
     par_file = os.path.join(folder, par_files[0])
     with open(par_file) as f:
@@ -32,6 +32,9 @@ def edit_par_file(folder, initial=False, parameter_names=[], parameter_values=[]
     if end_date:
         data["Simulation"]["End d"] = end_date
 
+    for key, value in simulation.items():
+        data["Simulation"][key] = value
+
     if len(parameter_names) > 0 and len(parameter_names) == len(parameter_values):
         for index, parameter in enumerate(parameter_names):
             data["ModelParameters"][parameter] = parameter_values[index]
@@ -61,7 +64,110 @@ def copy_simstrat_inputs(src, dst):
         else:
             shutil.copy2(s, d)
 
-def simstrat_rms(objective_variables, objective_weights, observations, reference_year, folder):
+def link_simstrat_inputs(src, dst, method="hardlink"):
+    if method not in ["hardlink", "symlink", "copy"]:
+        raise ValueError("Unrecognised run folder method {}".format(method))
+    for root, dirs, files in os.walk(src):
+        dirs[:] = [d for d in dirs if not (root == src and d == "Results")]
+        folder = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(folder, exist_ok=True)
+        for file in files:
+            s = os.path.join(root, file)
+            d = os.path.join(folder, file)
+            if file.endswith(".par") or method == "copy":
+                shutil.copy2(s, d)
+                continue
+            try:
+                if os.path.lexists(d):
+                    os.remove(d)
+                if method == "symlink":
+                    os.symlink(os.path.abspath(s), d)
+                else:
+                    os.link(s, d)
+            except OSError:
+                shutil.copy2(s, d)
+    os.makedirs(os.path.join(dst, "Results"), exist_ok=True)
+
+def compile_observation_index(objective_variables, objective_weights, observations):
+    observation_index = []
+    for i, objective_variable in enumerate(objective_variables):
+        obs = [o for o in observations if o["parameter"] == objective_variable]
+        if len(obs) != 1 or "df" not in obs[0]:
+            raise ValueError("Cannot find {} observations to calculate residuals".format(objective_variable))
+        df = obs[0]["df"]
+        time_keys, rows = np.unique(time_to_minutes(df.index), return_inverse=True)
+        depths, cols = np.unique(df["depth"].to_numpy(dtype=float), return_inverse=True)
+        observation_index.append({
+            "parameter": objective_variable,
+            "objective_weight": objective_weights[i],
+            "time_keys": time_keys,
+            "depths": depths,
+            "rows": rows.ravel(),
+            "cols": cols.ravel(),
+            "values": df["value"].to_numpy(dtype=float),
+            "weights": df["weight"].to_numpy(dtype=float)
+        })
+    return observation_index
+
+
+def time_to_minutes(index):
+    return index.tz_convert(None).values.astype("datetime64[m]").astype(np.int64)
+
+
+def align_output(keys, output_keys):
+    if len(output_keys) == 0:
+        return np.full(len(keys), -1)
+    order = np.argsort(output_keys, kind="stable")
+    sorted_keys = output_keys[order]
+    pos = np.clip(np.searchsorted(sorted_keys, keys), 0, len(sorted_keys) - 1)
+    return np.where(sorted_keys[pos] == keys, order[pos], -1)
+
+
+def gather_simulated(observation, output):
+    sim_rows = align_output(observation["time_keys"], output["time_keys"])
+    sim_cols = align_output(observation["depths"], output["depths"])
+    rows = sim_rows[observation["rows"]]
+    cols = sim_cols[observation["cols"]]
+    valid = (rows >= 0) & (cols >= 0)
+    simulated = np.full(len(rows), np.nan)
+    simulated[valid] = output["values"][rows[valid], cols[valid]]
+    return simulated
+
+
+def simstrat_simulated(observation_index, reference_year, folder, timer=None, dtype=np.float64, chunk_rows=None):
+    if timer is None:
+        timer = StageTimer()
+    simulated = []
+    for observation in observation_index:
+        objective_variable = observation["parameter"]
+        if objective_variable == "temperature":
+            with timer.stage("parse_output"):
+                output = read_output_matrix(os.path.join(folder, "T_out.dat"), reference_year,
+                                            time_keys=observation["time_keys"], depths=observation["depths"],
+                                            dtype=dtype, chunk_rows=chunk_rows)
+        else:
+            raise ValueError("Not implemented for objective variable {}".format(objective_variable))
+        with timer.stage("objective"):
+            simulated.append(gather_simulated(observation, output))
+    return simulated
+
+
+def simstrat_residuals(observation_index, simulated):
+    residuals = []
+    for observation, sim in zip(observation_index, simulated):
+        valid = ~np.isnan(sim) & ~np.isnan(observation["values"]) & ~np.isnan(observation["weights"])
+        residual = np.zeros(len(sim))
+        residual[valid] = (observation["objective_weight"] * observation["weights"][valid]) ** 0.5 * (observation["values"][valid] - sim[valid])
+        residuals.append(residual)
+    return np.concatenate(residuals)
+
+
+def simstrat_rms(observation_index, reference_year, folder, timer=None, simulated=None, dtype=np.float64, chunk_rows=None):
+    if timer is None:
+        timer = StageTimer()
+    if simulated is None:
+        simulated = simstrat_simulated(observation_index, reference_year, folder, timer=timer, dtype=dtype,
+                                       chunk_rows=chunk_rows)
     residuals = 0
     weights = 0
     surface_residuals = 0
@@ -69,40 +175,33 @@ def simstrat_rms(objective_variables, objective_weights, observations, reference
     bottom_residuals = 0
     bottom_weights = 0
     by_depth = {}
-    for i, objective_variable in enumerate(objective_variables):
-        if objective_variable == "temperature":
-            obs = [o for o in observations if o["parameter"] == "temperature"]
-            if len(obs) != 1:
-                raise ValueError("Cannot find temperature observations to calculate residuals")
-            obs = obs[0]
-            df_obs = parse_observation_file(obs["file"], datetime.fromisoformat(obs["start"]), datetime.fromisoformat(obs["end"]))
-            df_sim = parse_output_file(os.path.join(folder, "T_out.dat"), reference_year)
-            df_sim = df_sim.reset_index().melt(id_vars='time', var_name='depth', value_name='value')
-            df_sim['depth'] = df_sim['depth'].astype(float) * -1
-            df_sim['time'] = df_sim['time'].dt.round('min')
-            df = df_obs.merge(df_sim, on=['time', 'depth'], how='left', suffixes=('_obs', '_sim'))
-            df = df.dropna()
-        else:
-            raise ValueError("Not implemented for objective variable {}".format(objective_variable))
+    for observation, sim in zip(observation_index, simulated):
+        objective_variable = observation["parameter"]
+        with timer.stage("objective"):
+            valid = ~np.isnan(sim) & ~np.isnan(observation["values"]) & ~np.isnan(observation["weights"])
+            cols = observation["cols"][valid]
+            obj_weights = observation["objective_weight"] * observation["weights"][valid]
+            obs_residuals = obj_weights * (observation["values"][valid] - sim[valid]) ** 2
+            n_depths = len(observation["depths"])
+            depth_residuals = np.bincount(cols, weights=obs_residuals, minlength=n_depths)
+            depth_weights = np.bincount(cols, weights=obj_weights, minlength=n_depths)
+            depth_count = np.bincount(cols, minlength=n_depths)
+            observed = np.flatnonzero(depth_count)
 
-        df["residuals"] = (objective_weights[i] * df["weight"] * (df["value_obs"] - df["value_sim"]) ** 2)
-        df["obj_weights"] = (objective_weights[i] * df["weight"])
-        residuals = residuals + df['residuals'].sum()
-        weights = weights + df['obj_weights'].sum()
-        df_surface = df[df['depth'] == df['depth'].min()]
-        surface_residuals = surface_residuals + df_surface['residuals'].sum()
-        surface_weights = surface_weights + df_surface['obj_weights'].sum()
-        df_bottom = df[df['depth'] == df['depth'].max()]
-        bottom_residuals = bottom_residuals + df_bottom['residuals'].sum()
-        bottom_weights = bottom_weights + df_bottom['obj_weights'].sum()
-        dfd = df.groupby("depth").apply(
-            lambda g: pd.Series({
-                "rmse": (g['residuals'].sum() / g['obj_weights'].sum()) ** 0.5,
-                "count": len(g)
-            })
-        ).reset_index()
-        dfd.columns = ["depth", "rmse", "count"]
-        by_depth[objective_variable] = dfd.to_dict(orient='list')
+            residuals = residuals + obs_residuals.sum()
+            weights = weights + obj_weights.sum()
+            if len(observed) > 0:
+                surface_residuals = surface_residuals + depth_residuals[observed[0]]
+                surface_weights = surface_weights + depth_weights[observed[0]]
+                bottom_residuals = bottom_residuals + depth_residuals[observed[-1]]
+                bottom_weights = bottom_weights + depth_weights[observed[-1]]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rmse = (depth_residuals[observed] / depth_weights[observed]) ** 0.5
+            by_depth[objective_variable] = {
+                "depth": observation["depths"][observed].tolist(),
+                "rmse": rmse.tolist(),
+                "count": depth_count[observed].astype(float).tolist()
+            }
 
     overall = (residuals / weights) ** 0.5
     surface = (surface_residuals / surface_weights) ** 0.5 if surface_weights > 0 else None
@@ -116,14 +215,92 @@ def simstrat_rms(objective_variables, objective_weights, observations, reference
         }
 
 
-def parse_output_file(file, reference_year):
-    df = pd.read_csv(file)
-    base_date = pd.Timestamp('{}-01-01'.format(reference_year))
-    df["time"] = (base_date + pd.to_timedelta(df['Datetime'], unit='D')).dt.tz_localize('UTC')
-    df = df.drop('Datetime', axis=1)
-    df = df.set_index('time')
-    df = df.sort_index()
-    return df
+def read_output_matrix(file, reference_year, time_keys=None, depths=None, dtype=np.float64, chunk_rows=None):
+    with open(file) as f:
+        header = f.readline().strip().split(",")
+    output_depths = np.array(header[1:], dtype=float) * -1
+    columns = np.arange(len(output_depths)) if depths is None else np.flatnonzero(np.isin(output_depths, depths))
+    usecols = [0] + (columns + 1).tolist()
+    dtypes = {c: dtype for c in usecols}
+    dtypes[0] = np.float64
+    reader = pd.read_csv(file, skiprows=1, header=None, usecols=usecols, dtype=dtypes, chunksize=chunk_rows or 100000)
+    keys = []
+    values = []
+    for chunk in reader:
+        chunk_keys = output_time_keys(chunk[0].to_numpy(), reference_year)
+        chunk_values = chunk[usecols[1:]].to_numpy(dtype=dtype)
+        if time_keys is not None:
+            needed = align_output(chunk_keys, time_keys) >= 0
+            chunk_keys, chunk_values = chunk_keys[needed], chunk_values[needed]
+        keys.append(chunk_keys)
+        values.append(chunk_values)
+    return {
+        "time_keys": np.concatenate(keys) if len(keys) > 0 else np.empty(0, dtype=np.int64),
+        "depths": output_depths[columns],
+        "values": np.concatenate(values) if len(values) > 0 else np.empty((0, len(columns)), dtype=dtype)
+    }
+
+
+def output_time_keys(days, reference_year):
+    base_key = time_to_minutes(pd.DatetimeIndex([pd.Timestamp('{}-01-01'.format(reference_year), tz="UTC")]))[0]
+    offsets = pd.to_timedelta(days, unit='D').round("min").values.astype("timedelta64[m]").astype(np.int64)
+    return base_key + offsets
+
+
+class PartialObjective(object):
+    def __init__(self, observation_index, reference_year, folder):
+        self.observation_index = observation_index
+        self.reference_year = reference_year
+        self.files = {}
+        self.residuals = 0
+        self.weights = 0
+        for observation in observation_index:
+            if observation["parameter"] == "temperature":
+                self.files[observation["parameter"]] = {"path": os.path.join(folder, "T_out.dat"), "offset": 0,
+                                                        "partial": b"", "depths": None}
+            else:
+                raise ValueError("Not implemented for objective variable {}".format(observation["parameter"]))
+            valid = ~np.isnan(observation["values"]) & ~np.isnan(observation["weights"])
+            self.weights = self.weights + (observation["objective_weight"] * observation["weights"][valid]).sum()
+
+    def read_rows(self, file):
+        if not os.path.exists(file["path"]):
+            return None
+        with open(file["path"], "rb") as f:
+            f.seek(file["offset"])
+            data = f.read()
+        file["offset"] = file["offset"] + len(data)
+        lines = (file["partial"] + data).split(b"\n")
+        file["partial"] = lines.pop()
+        if file["depths"] is None and len(lines) > 0:
+            file["depths"] = np.array(lines.pop(0).decode().strip().split(",")[1:], dtype=float) * -1
+        lines = [line for line in lines if line.strip() != b""]
+        if len(lines) == 0:
+            return None
+        return np.array([line.decode().split(",") for line in lines], dtype=float)
+
+    def update(self):
+        for observation in self.observation_index:
+            file = self.files[observation["parameter"]]
+            rows = self.read_rows(file)
+            if rows is None:
+                continue
+            sim_rows = np.full(len(observation["time_keys"]), -1)
+            matched = align_output(output_time_keys(rows[:, 0], self.reference_year), observation["time_keys"])
+            sim_rows[matched[matched >= 0]] = np.flatnonzero(matched >= 0)
+            sim_cols = align_output(observation["depths"], file["depths"])
+            r = sim_rows[observation["rows"]]
+            c = sim_cols[observation["cols"]]
+            valid = (r >= 0) & (c >= 0) & ~np.isnan(observation["values"]) & ~np.isnan(observation["weights"])
+            simulated = rows[:, 1:][r[valid], c[valid]]
+            weights = observation["objective_weight"] * observation["weights"][valid]
+            residuals = weights * (observation["values"][valid] - simulated) ** 2
+            self.residuals = self.residuals + np.nansum(residuals)
+        return self.lower_bound()
+
+    def lower_bound(self):
+        return (self.residuals / self.weights) ** 0.5 if self.weights > 0 else 0.0
+
 
 def set_simstrat_outputs(calibration_folder, times, depths, reference_year):
     if len(depths) < 2:
@@ -0,0 +1,161 @@
+import os
+import json
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import minimize, OptimizeResult
+from scipy.stats import norm, qmc
+
+
+class GaussianProcess(object):
+    def __init__(self, length_scales=None, noise=1e-6):
+        self.length_scales = length_scales
+        self.noise = noise
+
+    def kernel(self, a, b, length_scales):
+        d = np.sqrt(np.sum(((a[:, None, :] - b[None, :, :]) / length_scales) ** 2, axis=-1)) * np.sqrt(5)
+        return (1 + d + d ** 2 / 3) * np.exp(-d)
+
+    def negative_log_likelihood(self, theta, X, y):
+        length_scales, noise = np.exp(theta[:-1]), np.exp(theta[-1])
+        K = self.kernel(X, X, length_scales) + (noise + 1e-10) * np.eye(len(X))
+        try:
+            factor = cho_factor(K, lower=True)
+        except np.linalg.LinAlgError:
+            return 1e25
+        alpha = cho_solve(factor, y)
+        return 0.5 * y @ alpha + np.sum(np.log(np.diag(factor[0])))
+
+    def fit(self, X, y, rng, optimize=True):
+        self.X = X
+        self.y_mean, self.y_std = y.mean(), y.std() if y.std() > 0 else 1.0
+        self.y = (y - self.y_mean) / self.y_std
+        if optimize or self.length_scales is None:
+            bounds = [(np.log(0.01), np.log(10))] * X.shape[1] + [(np.log(1e-8), np.log(0.1))]
+            starts = [np.r_[np.log(np.full(X.shape[1], 0.3)), np.log(1e-4)]]
+            starts += [rng.uniform([b[0] for b in bounds], [b[1] for b in bounds]) for i in range(4)]
+            best = None
+            for start in starts:
+                out = minimize(self.negative_log_likelihood, start, args=(X, self.y), method="L-BFGS-B", bounds=bounds)
+                if best is None or out.fun < best.fun:
+                    best = out
+            self.length_scales, self.noise = np.exp(best.x[:-1]), np.exp(best.x[-1])
+        K = self.kernel(X, X, self.length_scales) + (self.noise + 1e-10) * np.eye(len(X))
+        self.factor = cho_factor(K, lower=True)
+        self.alpha = cho_solve(self.factor, self.y)
+        return self
+
+    def predict(self, X):
+        k = self.kernel(X, self.X, self.length_scales)
+        mean = k @ self.alpha
+        v = cho_solve(self.factor, k.T)
+        variance = np.clip(1 - np.sum(k * v.T, axis=1), 1e-12, None)
+        return mean * self.y_std + self.y_mean, np.sqrt(variance) * self.y_std
+
+
+def expected_improvement(gp, X, best, xi=0.0):
+    mean, std = gp.predict(np.atleast_2d(X))
+    improvement = best - mean - xi
+    z = improvement / std
+    return improvement * norm.cdf(z) + std * norm.pdf(z)
+
+
+def propose_batch(gp, X, y, batch_size, rng, xi=0.0, candidates=2000):
+    dims = X.shape[1]
+    believer = GaussianProcess(gp.length_scales, gp.noise)
+    X_fit, y_fit = X.copy(), y.copy()
+    batch = []
+    for i in range(batch_size):
+        believer.fit(X_fit, y_fit, rng, optimize=False)
+        best = y_fit.min()
+        local = np.clip(X[np.argmin(y)] + rng.normal(0, 0.05, (candidates // 4, dims)), 0, 1)
+        pool = np.vstack([rng.uniform(0, 1, (candidates, dims)), local])
+        ei = expected_improvement(believer, pool, best, xi)
+        start = pool[np.argmax(ei)]
+        out = minimize(lambda x: -expected_improvement(believer, x, best, xi)[0], start, method="L-BFGS-B",
+                       bounds=[(0, 1)] * dims)
+        point = out.x if -out.fun > ei.max() else start
+        batch.append(point)
+        X_fit = np.vstack([X_fit, point])
+        y_fit = np.r_[y_fit, believer.predict(point[None, :])[0]]
+    return np.array(batch)
+
+
+def read_surrogate_inputs(path):
+    with open(path) as f:
+        state = json.load(f)
+    return state["inputs"] if "inputs" in state else None
+
+
+def read_surrogate_state(path, parameter_names, lower, upper):
+    with open(path) as f:
+        state = json.load(f)
+    if state["parameters"] != parameter_names:
+        raise ValueError("Surrogate state {} was created for parameters {}".format(path, state["parameters"]))
+    X = np.array(state["X"], dtype=float).reshape(-1, len(parameter_names))
+    inside = np.all((X >= lower) & (X <= upper), axis=1)
+    return X[inside], np.array(state["y"], dtype=float)[inside]
+
+
+def write_surrogate_state(path, parameter_names, lower, upper, X, y, gp, inputs_hash=None):
+    with open(path + ".tmp", "w") as f:
+        json.dump({
+            "inputs": inputs_hash,
+            "parameters": parameter_names,
+            "min": lower.tolist(),
+            "max": upper.tolist(),
+            "X": X.tolist(),
+            "y": y.tolist(),
+            "length_scales": None if gp is None else gp.length_scales.tolist(),
+            "noise": None if gp is None else float(gp.noise)
+        }, f)
+    os.replace(path + ".tmp", path)
+
+
+def surrogate_minimize(fun, x0, args=(), bounds=None, parameter_names=None, maxfev=100, initial_points=None,
+                       batch_size=4, workers=4, xi=0.0, seed=None, state_file=None, warm_start=None,
+                       inputs_hash=None, callback=None):
+    lower, upper = np.array(bounds, dtype=float).T
+    dims = len(lower)
+    rng = np.random.default_rng(seed)
+    initial_points = 2 * dims + 1 if initial_points is None else initial_points
+
+    X, y = np.empty((0, dims)), np.empty(0)
+    if warm_start is not None and os.path.exists(warm_start):
+        X, y = read_surrogate_state(warm_start, parameter_names, lower, upper)
+    evaluations = 0
+    batches = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def evaluate(points):
+            return np.array(list(pool.map(fun, list(points), *[[a] * len(points) for a in args])), dtype=float)
+
+        design = np.clip(np.asarray(x0, dtype=float), lower, upper)[None, :]
+        if initial_points > 1:
+            sample = qmc.LatinHypercube(d=dims, seed=rng).random(initial_points - 1)
+            design = np.vstack([design, lower + sample * (upper - lower)])
+        design = design[:max(0, min(maxfev, initial_points - len(X)))]
+        if len(design) > 0:
+            X, y = np.vstack([X, design]), np.r_[y, evaluate(design)]
+            evaluations += len(design)
+
+        gp = None
+        while evaluations < maxfev:
+            valid = np.isfinite(y)
+            gp = GaussianProcess().fit((X[valid] - lower) / (upper - lower), y[valid], rng)
+            batch = propose_batch(gp, (X[valid] - lower) / (upper - lower), y[valid],
+                                  min(batch_size, maxfev - evaluations), rng, xi)
+            batch = lower + batch * (upper - lower)
+            X, y = np.vstack([X, batch]), np.r_[y, evaluate(batch)]
+            evaluations += len(batch)
+            batches += 1
+            if state_file is not None:
+                write_surrogate_state(state_file, parameter_names, lower, upper, X, y, gp, inputs_hash)
+            if callback is not None:
+                callback(X[np.nanargmin(y)])
+
+    if state_file is not None:
+        write_surrogate_state(state_file, parameter_names, lower, upper, X, y, gp, inputs_hash)
+    best = int(np.nanargmin(y))
+    return OptimizeResult(x=X[best], fun=y[best], nfev=evaluations, nit=batches, success=True,
+                          message="Maximum number of function evaluations reached.")
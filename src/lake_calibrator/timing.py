@@ -0,0 +1,93 @@
+import os
+import sys
+import json
+import time
+import numpy as np
+from datetime import datetime
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.durations = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0) + time.perf_counter() - start
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+
+def lifetime_peak_rss_mb():
+    if resource is None:
+        return None, None
+    scale = 1024 ** 2 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def bytes_written(folder):
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            stat = os.lstat(os.path.join(root, file))
+            if stat.st_nlink == 1 and not os.path.islink(os.path.join(root, file)):
+                total += stat.st_size
+    return total
+
+
+def write_timing_record(calibration_folder, run, parameter_values, error, timer, cached=False, written=0):
+    rss, child_rss = lifetime_peak_rss_mb()
+    record = {
+        "time": datetime.now().isoformat(),
+        "run": run,
+        "pid": os.getpid(),
+        "parameters": [float(v) for v in parameter_values],
+        "error": error,
+        "cached": cached,
+        "durations": timer.durations,
+        "total": timer.total(),
+        "lifetime_peak_rss_mb": rss,
+        "lifetime_child_peak_rss_mb": child_rss,
+        "bytes_written": written
+    }
+    with open(os.path.join(calibration_folder, "timings.jsonl"), "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def summarise_timings(calibration_folder, wall_time, since=""):
+    path = os.path.join(calibration_folder, "timings.jsonl")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip() != ""]
+    records = [r for r in records if not r["cached"] and r["time"] >= since]
+    stages = {}
+    for record in records:
+        for stage, duration in record["durations"].items():
+            stages.setdefault(stage, []).append(duration)
+        stages.setdefault("total", []).append(record["total"])
+    summary = {
+        "evaluations": len(records),
+        "wall_time": wall_time,
+        "evaluations_per_hour": len(records) / wall_time * 3600 if wall_time > 0 else None,
+        "stages": {stage: {"median": float(np.median(d)), "p95": float(np.percentile(d, 95)), "sum": float(np.sum(d))}
+                   for stage, d in stages.items()}
+    }
+    rss = [r["lifetime_peak_rss_mb"] for r in records if r["lifetime_peak_rss_mb"] is not None]
+    if len(rss) > 0:
+        summary["lifetime_peak_rss_mb"] = max(rss)
+        summary["lifetime_child_peak_rss_mb"] = max(r["lifetime_child_peak_rss_mb"] for r in records)
+    summary["bytes_written"] = int(sum(r["bytes_written"] for r in records))
+    return summary
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+import sys
+import subprocess
+
+DONE = "__lake_calibrator_done__"
+
+
+def worker(execute):
+    for line in sys.stdin:
+        folder = line.strip()
+        if folder == "":
+            continue
+        process = subprocess.run(execute.format(calibration_folder=folder), shell=True, cwd=folder,
+                                 stderr=subprocess.STDOUT)
+        sys.stdout.write("{} {}\n".format(DONE, process.returncode))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise ValueError("Usage: python worker.py <execute command>")
+    worker(sys.argv[1])
@@ -0,0 +1,66 @@
+import os
+import sys
+import json
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(TESTS, "..", "src")
+sys.path.insert(0, SRC)
+sys.path.insert(0, os.path.join(TESTS, "..", "benchmarks"))
+
+from benchmark import create_lake, FAKE_SIMSTRAT
+from batch_calibrate import plan_lakes, batch_calibrator
+
+POOL_WORKER = '''import os
+import sys
+import time
+sys.path.insert(0, {src!r})
+from lake_calibrator.worker import worker
+with open(sys.argv[1], "a") as f:
+    f.write("start {{}} {{}}\\n".format(sys.argv[2], time.time()))
+try:
+    worker(sys.argv[3])
+finally:
+    with open(sys.argv[1], "a") as f:
+        f.write("end {{}} {{}}\\n".format(sys.argv[2], time.time()))
+'''
+
+
+def write_lake(folder, name, options, pool_worker, pool_log):
+    args = create_lake(os.path.join(folder, name), 1, 5, profiles_per_year=12, forcing_mb=0.01)
+    args["calibration_options"].update(options)
+    args["calibration_options"]["cache"] = False
+    args["calibration_options"]["executor"]["command"] = "{} {} {} {{calibration_folder}} '{} {} {{{{calibration_folder}}}}/Calibration.par'".format(
+        sys.executable, pool_worker, pool_log, sys.executable, FAKE_SIMSTRAT)
+    arg_file = os.path.join(folder, "{}.json".format(name))
+    with open(arg_file, "w") as f:
+        json.dump(args, f)
+    return arg_file
+
+
+def test_pool_workers_count_against_the_batch_budget(tmp_path):
+    folder = str(tmp_path)
+    pool_worker = os.path.join(folder, "pool_worker.py")
+    pool_log = os.path.join(folder, "pool.log")
+    with open(pool_worker, "w") as f:
+        f.write(POOL_WORKER.format(src=os.path.abspath(SRC)))
+    arg_files = [
+        write_lake(folder, "de", {"method": "differential_evolution", "workers": 2, "maxiter": 1, "popsize": 2, "seed": 1,
+                                  "executor": {"type": "pool", "workers": 3}}, pool_worker, pool_log),
+        write_lake(folder, "nm", {"method": "Nelder-Mead", "maxfev": 50, "disp": False, "fatol": 1, "xatol": 1,
+                                  "executor": {"type": "pool", "workers": 3}}, pool_worker, pool_log)
+    ]
+    budget = 4
+    assert {lake["name"]: lake["workers"] for lake in plan_lakes(arg_files, budget)} == {"de": 2, "nm": 3}
+
+    lakes = batch_calibrator(arg_files, budget, os.path.join(folder, "index.json"), os.path.join(folder, "logs"))
+    assert all(lake["status"] == "completed" for lake in lakes)
+
+    with open(pool_log) as f:
+        events = sorted((float(t), 1 if kind == "start" else -1, lake) for kind, lake, t in (line.split() for line in f))
+    for lake in lakes:
+        started = sum(1 for t, change, name in events if change == 1 and name == lake["args"]["calibration_folder"])
+        assert 0 < started <= lake["workers"], lake["name"]
+    running = 0
+    for t, change, name in events:
+        running += change
+        assert running <= budget
@@ -0,0 +1,45 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from lake_calibrator.functions import Logger
+from lake_calibrator.pest_calibrate import read_pest_jco, write_pest_jco, write_pest_observation_keys, seed_pest_jacobian
+
+
+def write_calibration(folder, parameters, times, depths, time_id, depth_id):
+    os.makedirs(folder)
+    names = ["t_{}_{}".format(i, j) for i, j in zip(time_id, depth_id)]
+    with open(os.path.join(folder, "pest.pst"), "w") as f:
+        f.write("pcf\n* parameter data\n")
+        f.writelines("{} none factor 1 0 2 fit 1.0 0.0 1\n".format(name) for name in parameters)
+        f.write("* observation data\n")
+        f.writelines("{} 1.0 1.0 temperature\n".format(name) for name in names)
+        f.write("* model command line\n")
+    write_pest_observation_keys(folder, [{"group": "temperature", "time_id": np.array(time_id), "depth_id": np.array(depth_id)}],
+                                times, depths)
+    return names
+
+
+def test_seed_jacobian_is_mapped_onto_new_observations(tmp_path):
+    times = list(pd.date_range("2000-01-01", periods=4, freq="D", tz="UTC"))
+    depths = [0.0, 5.0, 10.0]
+    seed = str(tmp_path / "seed")
+    seed_names = write_calibration(seed, ["f_wind", "p_lw", "a_seiche"], times, depths,
+                                   [0, 0, 1, 2, 2, 3], [0, 2, 1, 0, 1, 2])
+    jacobian = np.arange(18, dtype=float).reshape(6, 3)
+    jacobian[2, 1] = 0
+    write_pest_jco(os.path.join(seed, "pest.jco"), jacobian, ["f_wind", "p_lw", "a_seiche"], seed_names)
+
+    new = str(tmp_path / "new")
+    new_names = write_calibration(new, ["p_lw", "f_wind"], times[1:3], [5.0, 10.0], [0, 1, 1], [1, 0, 1])
+    assert seed_pest_jacobian(new, seed, False, Logger()) == (["/i"], "seed.jco")
+
+    mapped, parameter_names, observation_names = read_pest_jco(os.path.join(new, "seed.jco"))
+    assert parameter_names == ["p_lw", "f_wind"]
+    assert observation_names == new_names
+    assert np.array_equal(mapped, jacobian[np.ix_([2, 3, 4], [1, 0])])
+
+    assert seed_pest_jacobian(seed, new, False, Logger()) == ([], None)
@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from lake_calibrator.functions import Logger
+from lake_calibrator.pest_monitor import PestMonitor
+
+REC = """                             PEST RUN RECORD: CASE pest
+
+ PEST run mode:-
+    Parameter estimation mode
+
+ INITIAL CONDITIONS:
+    Sum of squared weighted residuals (ie phi)                =    1523.4
+    Contribution to phi from observation group "temperature"  =    1523.4
+
+OPTIMISATION ITERATION NO.        : 1
+  Model calls so far               : 1
+  Starting phi for this iteration                     :    1523.4
+  Contribution to phi from observation group "temperature" :    1523.4
+
+       Lambda =   5.0000     ----->
+          Phi =    812.77     (  0.534 of starting phi)
+
+  No more lambdas: relative phi reduction between lambdas less than 0.0300
+  Lowest phi this iteration:    812.77
+
+OPTIMISATION ITERATION NO.        : 2
+  Model calls so far               : 4
+  Starting phi for this iteration                     :    812.77
+  Contribution to phi from observation group "temperature" :    812.77
+
+       Lambda =   2.5000     ----->
+          Phi =    640.12     (  0.788 of starting phi)
+
+  Lowest phi this iteration:    640.12
+"""
+
+RMR = """ PEST_HP RUN MANAGEMENT RECORD
+ CASE pest
+
+ PEST_HP is listening on port 4005.
+
+ 10:02:11.25 :- new agent with id = 1 on host "node1" has been registered.
+ 10:02:11.31 :- new agent with id = 2 on host "node2" has been registered.
+
+ ITERATION NUMBER 0 ----->
+
+ 10:02:11.40 :- run 1 commenced on agent with id = 1.
+ 10:02:15.62 :- run 1 completed on agent with id = 1; run time = 4.22 seconds.
+
+ ITERATION NUMBER 1 ----->
+
+ 10:02:15.70 :- run 2 commenced on agent with id = 1.
+ 10:02:15.71 :- run 3 commenced on agent with id = 2.
+ 10:02:19.90 :- run 2 completed on agent with id = 1; run time = 4.20 seconds.
+ 10:02:20.35 :- run 3 failed on agent with id = 2.
+ 10:02:20.36 :- run 3 will be re-assigned; 1 failure(s) recorded for this run.
+ 10:02:20.40 :- run 3 commenced on agent with id = 1.
+ 10:02:24.80 :- run 3 completed on agent with id = 1; run time = 4.40 seconds.
+ 10:02:24.90 :- run 4 commenced on agent with id = 2.
+ 10:03:54.90 :- run 4 completed on agent with id = 2; run time = 1.50 min.
+"""
+
+
+def test_monitor_reads_pest_records_in_partial_chunks(tmp_path):
+    folder = str(tmp_path)
+    monitor = PestMonitor(folder, Logger())
+    rec_split = REC.index("Lowest phi this iteration:    812") + 20
+    rmr_split = RMR.index("run 3 failed on") + 8
+    with open(os.path.join(folder, "pest.rec"), "w") as f:
+        f.write(REC[:rec_split])
+    with open(os.path.join(folder, "pest.rmr"), "w") as f:
+        f.write(RMR[:rmr_split])
+    monitor.poll()
+    assert monitor.state["completed_runs"] == 2
+    assert monitor.state["failed_runs"] == 0
+    assert monitor.state["phi_by_iteration"] == {"1": 1523.4}
+
+    with open(os.path.join(folder, "pest.rec"), "a") as f:
+        f.write(REC[rec_split:])
+    with open(os.path.join(folder, "pest.rmr"), "a") as f:
+        f.write(RMR[rmr_split:])
+    monitor.poll()
+
+    summary = monitor.summary()
+    assert summary["phi_by_iteration"] == {"1": 812.77, "2": 640.12}
+    assert summary["iteration"] == 2
+    assert summary["model_runs"] == 4
+    assert summary["failed_runs"] == 1
+    assert monitor.state["agents"]["1"] == {"runs": 3, "failed": 0, "run_times": [4.22, 4.20, 4.40]}
+    assert monitor.state["agents"]["2"] == {"runs": 1, "failed": 1, "run_times": [90.0]}
+    with open(os.path.join(folder, "pest_progress.jsonl")) as f:
+        assert len([json.loads(line) for line in f]) == 2
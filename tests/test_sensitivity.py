@@ -0,0 +1,24 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from lake_calibrator.sensitivity import morris_sample, morris_indices
+
+
+def test_morris_sample_stays_inside_bounds():
+    for levels in [2, 3, 4, 5, 6]:
+        rng = np.random.default_rng(levels)
+        u = morris_sample(3, 30, levels, rng)
+        assert u.min() >= 0 and u.max() <= 1, levels
+        effects = morris_indices(u, u @ np.array([3.0, -1.0, 0.5]), 3, rng, 10)
+        assert np.allclose(effects["mu"], [3.0, -1.0, 0.5])
+
+
+def test_morris_sample_stays_on_the_level_grid():
+    for levels in [2, 3, 4, 5, 6, 7]:
+        u = morris_sample(4, 30, levels, np.random.default_rng(levels))
+        steps = u * (levels - 1)
+        assert np.allclose(steps, np.round(steps)), levels
+        assert len(np.unique(np.round(steps))) == levels, levels
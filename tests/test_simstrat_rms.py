@@ -0,0 +1,115 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from lake_calibrator.functions import parse_observation_file
+from lake_calibrator.simstrat import compile_observation_index, simstrat_rms
+
+REFERENCE_YEAR = 1981
+START = datetime(2000, 1, 1, tzinfo=timezone.utc)
+END = datetime(2001, 1, 1, tzinfo=timezone.utc)
+
+
+def reference_parse_output_file(file, reference_year):
+    df = pd.read_csv(file)
+    base_date = pd.Timestamp('{}-01-01'.format(reference_year))
+    df["time"] = (base_date + pd.to_timedelta(df['Datetime'], unit='D')).dt.tz_localize('UTC')
+    df = df.drop('Datetime', axis=1)
+    df = df.set_index('time')
+    df = df.sort_index()
+    return df
+
+
+def reference_simstrat_rms(objective_weights, df_obs, reference_year, folder):
+    residuals = 0
+    weights = 0
+    surface_residuals = 0
+    surface_weights = 0
+    bottom_residuals = 0
+    bottom_weights = 0
+    by_depth = {}
+    df_sim = reference_parse_output_file(os.path.join(folder, "T_out.dat"), reference_year)
+    df_sim = df_sim.reset_index().melt(id_vars='time', var_name='depth', value_name='value')
+    df_sim['depth'] = df_sim['depth'].astype(float) * -1
+    df_sim['time'] = df_sim['time'].dt.round('min')
+    df = df_obs.merge(df_sim, on=['time', 'depth'], how='left', suffixes=('_obs', '_sim'))
+    df = df.dropna()
+
+    df["residuals"] = (objective_weights[0] * df["weight"] * (df["value_obs"] - df["value_sim"]) ** 2)
+    df["obj_weights"] = (objective_weights[0] * df["weight"])
+    residuals = residuals + df['residuals'].sum()
+    weights = weights + df['obj_weights'].sum()
+    df_surface = df[df['depth'] == df['depth'].min()]
+    surface_residuals = surface_residuals + df_surface['residuals'].sum()
+    surface_weights = surface_weights + df_surface['obj_weights'].sum()
+    df_bottom = df[df['depth'] == df['depth'].max()]
+    bottom_residuals = bottom_residuals + df_bottom['residuals'].sum()
+    bottom_weights = bottom_weights + df_bottom['obj_weights'].sum()
+    dfd = df.groupby("depth").apply(
+        lambda g: pd.Series({
+            "rmse": (g['residuals'].sum() / g['obj_weights'].sum()) ** 0.5,
+            "count": len(g)
+        })
+    ).reset_index()
+    dfd.columns = ["depth", "rmse", "count"]
+    by_depth["temperature"] = dfd.to_dict(orient='list')
+
+    return {
+        "overall": (residuals / weights) ** 0.5,
+        "surface": (surface_residuals / surface_weights) ** 0.5 if surface_weights > 0 else None,
+        "bottom": (bottom_residuals / bottom_weights) ** 0.5 if bottom_weights > 0 else None,
+        "by_depth": by_depth
+    }
+
+
+def write_case(folder, seed):
+    rng = np.random.default_rng(seed)
+    output_depths = np.array([0.0, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0])
+    start_day = (pd.Timestamp(START) - pd.Timestamp("{}-01-01".format(REFERENCE_YEAR), tz="UTC")).days
+    days = start_day + np.arange(0, 366, 1 / 8)
+    values = 4 + 15 * rng.random((len(days), len(output_depths)))
+    values[rng.random(values.shape) < 0.05] = np.nan
+    results = os.path.join(folder, "Results")
+    os.makedirs(results)
+    header = "Datetime," + ",".join("{:g}".format(-d) for d in output_depths)
+    np.savetxt(os.path.join(results, "T_out.dat"), np.column_stack([days, values]), delimiter=",", header=header,
+               comments="", fmt="%.10g")
+
+    n = 3000
+    times = pd.Timestamp(START) + pd.to_timedelta(rng.integers(0, 365 * 8, n) * 3, unit="h")
+    times = times + pd.to_timedelta(rng.integers(-20, 20, n), unit="s")
+    depths = rng.choice(np.r_[output_depths[1:], [3.3, 60.0]], n)
+    obs = pd.DataFrame({
+        "time": times.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+        "depth": -depths,
+        "value": 4 + 15 * rng.random(n),
+        "weight": rng.choice([0.5, 1.0, 2.0], n)
+    })
+    obs.loc[rng.random(n) < 0.03, "value"] = np.nan
+    duplicates = obs.iloc[:200].copy()
+    duplicates["value"] = duplicates["value"] + 1
+    obs = pd.concat([obs, duplicates, obs.iloc[200:300]])
+    obs.to_csv(os.path.join(folder, "temperature.csv"), index=False)
+    return os.path.join(folder, "temperature.csv")
+
+
+def test_simstrat_rms_matches_melt_merge_groupby(tmp_path):
+    for seed in range(3):
+        folder = tmp_path / str(seed)
+        folder.mkdir()
+        file = write_case(str(folder), seed)
+        df_obs = parse_observation_file(file, START, END)
+        observation_index = compile_observation_index(["temperature"], [1.5], [{"parameter": "temperature", "df": df_obs}])
+
+        expected = reference_simstrat_rms([1.5], df_obs, REFERENCE_YEAR, os.path.join(str(folder), "Results"))
+        result = simstrat_rms(observation_index, REFERENCE_YEAR, os.path.join(str(folder), "Results"))
+
+        for key in ["overall", "surface", "bottom"]:
+            assert np.isclose(result[key], expected[key], rtol=1e-12), key
+        for key in ["depth", "rmse", "count"]:
+            assert np.allclose(result["by_depth"]["temperature"][key], expected["by_depth"]["temperature"][key],
+                               rtol=1e-12), key